@@ -9,13 +9,22 @@ import ipdb
 import os
 import logging
 import csv
+import json
+import pickle
+import hashlib
+from array import array
 import pandas as pd
 from pathlib import Path
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict
+from collections.abc import Mapping, Sequence
 from tqdm import tqdm
 from impresso.helpers import compute_levenshtein_distance
-from typing import NamedTuple
-from cassis import Cas, load_cas_from_xmi, load_typesystem
+from impresso.helpers.xmi import get_typesystem
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from lxml import etree
+from cassis import Cas, TypeSystem, load_cas_from_xmi
+from cassis.cas import Utf16CodepointOffsetConverter
 
 BIBLIO_ENTITIES = [
     "primary-full",
@@ -67,7 +76,7 @@ AjmcDocument = NamedTuple(
         ("filename", str),
         ("filepath", str),
         ("sentences", dict),
-        ("mentions", dict),
+        ("mentions", "RecordMapping"),
         ("hyphenated_words", list),
         ("links", list),
         ("text", str),
@@ -75,12 +84,488 @@ AjmcDocument = NamedTuple(
 )
 
 
-def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDocument:
+class RecordTable:
+    """Struct-of-arrays storage of annotations of one kind (e.g. tokens, mentions).
+
+    Rather than one dict per annotation, integer fields are kept in compact int32
+    arrays, fields with few distinct values as int32 codes into a vocabulary and
+    the surface as a slice of the document text. The dicts are only created, a
+    range at a time, when the annotations are read through `RecordList` or
+    `RecordMapping`.
+
+    Annotations are added one at a time with `append`, and `freeze` completes
+    the vocabularies once all of them are added.
+    """
+
+    KEYS: Tuple[str, ...] = ()
+    INT_FIELDS: Tuple[str, ...] = ()
+    FLOAT_FIELDS: Tuple[str, ...] = ()
+    LABEL_FIELDS: Tuple[str, ...] = ()
+    OBJECT_FIELDS: Tuple[str, ...] = ()
+    CONSTANT_FIELDS: Dict[str, object] = {}
+
+    def __init__(self, text: str):
+        """Create an empty table.
+
+        :param str text: text of the document, which the surfaces are slices of.
+        :return: None
+        :rtype: None
+
+        """
+        self.text = text
+        self.columns = {}
+        self.vocabularies = {}
+        self._codes = {}
+
+        for key in self.INT_FIELDS + self.LABEL_FIELDS:
+            self.columns[key] = array("i")
+        for key in self.FLOAT_FIELDS:
+            self.columns[key] = array("d")
+        for key in self.LABEL_FIELDS:
+            self._codes[key] = {}
+        for key in self.OBJECT_FIELDS:
+            self.columns[key] = []
+
+        self.length = 0
+
+    def append(self, **fields) -> None:
+        """Add an annotation, given its fields but the constant ones and the surface."""
+        columns = self.columns
+        try:
+            for key in self.INT_FIELDS + self.FLOAT_FIELDS + self.OBJECT_FIELDS:
+                columns[key].append(fields[key])
+            for key in self.LABEL_FIELDS:
+                codes = self._codes[key]
+                columns[key].append(codes.setdefault(fields[key], len(codes)))
+        except Exception:
+            # keep all the columns of the same length
+            for column in columns.values():
+                del column[self.length:]
+            raise
+        self.length += 1
+
+    def freeze(self) -> None:
+        """Complete the vocabularies, once all the annotations are added."""
+        for key in self.LABEL_FIELDS:
+            self.vocabularies[key] = list(self._codes[key])
+        self._codes = {}
+
+    def __len__(self) -> int:
+        return self.length
+
+    def surface(self, start: int, end: int) -> str:
+        """Return the surface of an annotation, as sliced from the text."""
+        return self.text[start:end]
+
+    def surfaces(self, starts: List[int], ends: List[int]) -> List[str]:
+        """Return the surfaces of annotations, as sliced from the text."""
+        text = self.text
+        return [text[start:end] for start, end in zip(starts, ends)]
+
+    def records(self, start: int = 0, stop: Optional[int] = None) -> List[dict]:
+        """Return a range of the annotations as dicts.
+
+        :param int start: position of the first annotation.
+        :param int stop: position after the last annotation, the end of the table by default.
+        :return: The annotations, with the keys in `KEYS`.
+        :rtype: List[dict]
+
+        """
+        stop = self.length if stop is None else min(stop, self.length)
+        n = max(stop - start, 0)
+
+        values = {}
+        for key in self.INT_FIELDS + self.FLOAT_FIELDS:
+            values[key] = self.columns[key][start:stop].tolist()
+        for key in self.LABEL_FIELDS:
+            vocabulary = self.vocabularies[key]
+            values[key] = [vocabulary[code] for code in self.columns[key][start:stop].tolist()]
+        for key in self.OBJECT_FIELDS:
+            values[key] = self.columns[key][start:stop]
+        for key, value in self.CONSTANT_FIELDS.items():
+            values[key] = [value] * n
+        values["surface"] = self.surfaces(values["start_offset"], values["end_offset"])
+
+        keys = self.KEYS
+        return [dict(zip(keys, record)) for record in zip(*[values[key] for key in keys])]
+
+
+    def record(self, index: int) -> dict:
+        """Return one annotation as a dict, see `records`."""
+        columns = self.columns
+        values = dict(self.CONSTANT_FIELDS)
+        for key in self.INT_FIELDS + self.FLOAT_FIELDS:
+            values[key] = columns[key][index]
+        for key in self.LABEL_FIELDS:
+            values[key] = self.vocabularies[key][columns[key][index]]
+        for key in self.OBJECT_FIELDS:
+            values[key] = columns[key][index]
+        values["surface"] = self.surface(values["start_offset"], values["end_offset"])
+
+        return {key: values[key] for key in self.KEYS}
+
+
+class TokenTable(RecordTable):
+    """Tokens of a document, see `read_xmi`."""
+
+    KEYS = ("id", "ann_layer", "start_offset", "end_offset", "surface", "segment_id")
+    INT_FIELDS = ("id", "start_offset", "end_offset", "segment_id")
+    CONSTANT_FIELDS = {"ann_layer": "de.tudarmstadt.ukp.dkpro.core.api.segmentation.type.Token"}
+
+
+class MentionTable(RecordTable):
+    """Named entity mentions of a document, see `read_xmi`."""
+
+    KEYS = (
+        "id",
+        "id_cont",
+        "ann_layer",
+        "entity_fine",
+        "entity_coarse",
+        "entity_biblio",
+        "start_offset",
+        "end_offset",
+        "literal",
+        "surface",
+        "noisy_ocr",
+        "transcript",
+        "levenshtein_norm",
+    )
+    INT_FIELDS = ("id", "id_cont", "start_offset", "end_offset")
+    FLOAT_FIELDS = ("levenshtein_norm",)
+    LABEL_FIELDS = ("entity_fine", "entity_coarse", "entity_biblio", "noisy_ocr")
+    OBJECT_FIELDS = ("transcript",)
+    CONSTANT_FIELDS = {"ann_layer": "webanno.custom.AjMCNamedEntity", "literal": "true"}
+
+    def surface(self, start: int, end: int) -> str:
+        return super().surface(start, end).replace("\n", "")
+
+    def surfaces(self, starts: List[int], ends: List[int]) -> List[str]:
+        return [surface.replace("\n", "") for surface in super().surfaces(starts, ends)]
+
+
+class RecordList(Sequence):
+    """List-like view of a range of the annotations of a `RecordTable` (e.g. the tokens of a segment).
+
+    Annotations are returned as new dicts, changing them does not change the table.
+    """
+
+    def __init__(self, table: RecordTable, start: int = 0, stop: Optional[int] = None):
+        self.table = table
+        self.start = start
+        self.stop = len(table) if stop is None else stop
+
+    def __len__(self) -> int:
+        return self.stop - self.start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.table.record(self.start + j) for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("record index out of range")
+        return self.table.record(self.start + i)
+
+    def __iter__(self):
+        return iter(self.table.records(self.start, self.stop))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (RecordList, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+
+class RecordMapping(Mapping):
+    """Dict-like view of the annotations of a `RecordTable`, by their id.
+
+    Annotations are returned as new dicts, changing them does not change the table.
+    """
+
+    def __init__(self, table: RecordTable):
+        self.table = table
+        self.positions = {value: index for index, value in enumerate(table.columns["id"].tolist())}
+
+    def __getitem__(self, value) -> dict:
+        return self.table.record(self.positions[value])
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def values(self) -> RecordList:
+        return RecordList(self.table)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Mapping):
+            return list(self.items()) == list(other.items())
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class OffsetIndex:
+    """Offset-sorted index over annotations (e.g. mentions, hyphenated words).
+
+    Annotations are sorted by start offset and a segment tree keeps the maximum
+    end offset of each range of them, so that the annotations overlapping a token
+    are found in O(log n + k) rather than by scanning all of them.
+    """
+
+    def __init__(self, annotations: List[dict]):
+        """Build the index.
+
+        :param list annotations: dicts with `start_offset` and `end_offset` keys, in document order.
+        :return: None
+        :rtype: None
+
+        """
+        order = sorted(range(len(annotations)), key=lambda i: annotations[i]["start_offset"])
+
+        self.positions = order
+        self.annotations = [annotations[i] for i in order]
+        self.starts = [ann["start_offset"] for ann in self.annotations]
+
+        size = 1
+        while size < len(self.annotations):
+            size *= 2
+        self.size = size
+
+        # leaves hold the end offsets, inner nodes the max end offset of their children
+        max_ends = [-1] * (2 * size)
+        for i, ann in enumerate(self.annotations):
+            max_ends[size + i] = ann["end_offset"]
+        for node in range(size - 1, 0, -1):
+            max_ends[node] = max(max_ends[2 * node], max_ends[2 * node + 1])
+        self.max_ends = max_ends
+
+    def _ending_after(self, lo: int, hi: int, offset: int) -> List[int]:
+        """Return the sorted positions in [lo, hi) of annotations ending after `offset`."""
+        found = []
+        stack = [(1, 0, self.size)]
+        while stack:
+            node, node_lo, node_hi = stack.pop()
+            if node_hi <= lo or node_lo >= hi or self.max_ends[node] <= offset:
+                continue
+            if node >= self.size:
+                found.append(node - self.size)
+            else:
+                mid = (node_lo + node_hi) // 2
+                stack.append((2 * node + 1, mid, node_hi))
+                stack.append((2 * node, node_lo, mid))
+        return found
+
+    def lookup(self, start_offset: int, end_offset: int) -> List[Tuple[str, dict]]:
+        """Find the annotations overlapping a token.
+
+        An annotation starting within the token is returned with "B", one that
+        starts before the token and covers its first character with "I".
+
+        :param int start_offset: start offset of the token.
+        :param int end_offset: end offset of the token.
+        :return: (IOB prefix, annotation) pairs in document order.
+        :rtype: List[Tuple[str, dict]]
+
+        """
+        lo = bisect_left(self.starts, start_offset)
+        hi = max(lo, bisect_left(self.starts, end_offset))
+        upto = bisect_right(self.starts, start_offset)
+
+        matches = [("B", i) for i in range(lo, hi)]
+        matches += [("I", i) for i in self._ending_after(0, lo, start_offset)]
+        if upto > hi:
+            matches += [("I", i) for i in self._ending_after(hi, upto, start_offset)]
+
+        matches.sort(key=lambda match: self.positions[match[1]])
+        return [(iob, self.annotations[i]) for iob, i in matches]
+
+
+class XmiAnnotation:
+    """An annotation read by `XmiAnnotations`, with the attributes of a cassis annotation."""
+
+    def __init__(self, annotations: "XmiAnnotations", features: dict):
+        self._annotations = annotations
+        self.__dict__.update(features)
+
+    def get_covered_text(self) -> str:
+        return self._annotations.sofa_string[self.begin:self.end]
+
+
+class XmiAnnotations:
+    """Annotations of a few types streamed from a CAS/XMI file with lxml.
+
+    Only the annotations of the requested types and the text of the initial view
+    are kept, which is much faster and leaner than building the whole CAS. The
+    part of the cassis `Cas` interface used by `read_xmi` (`select`,
+    `select_covered` and `sofa_string`) behaves as with a CAS loaded by cassis.
+    """
+
+    XMI_ID = "{http://www.omg.org/XMI}id"
+    SOFA_TAG = "{http:///uima/cas.ecore}Sofa"
+    VIEW_TAG = "{http:///uima/cas.ecore}View"
+
+    def __init__(self, xmi_file: str, typesystem: TypeSystem, type_names: Iterable[str]):
+        """Read the annotations.
+
+        :param str xmi_file: path to xmi_file.
+        :param TypeSystem typesystem: type system of the document.
+        :param list type_names: full names of the annotation types to read.
+        :return: None
+        :rtype: None
+
+        """
+        self.sofa_string = None
+        self._annotations = {}
+        self._keys = {}
+
+        # e.g. webanno.custom.GoldSentences -> {http:///webanno/custom.ecore}GoldSentences
+        tags = {}
+        for type_name in type_names:
+            namespace, _, short_name = type_name.rpartition(".")
+            tag = "{http:///%s.ecore}%s" % (namespace.replace(".", "/"), short_name)
+            tags[tag] = (type_name, self._feature_parsers(typesystem, type_name))
+
+        features_by_type = {type_name: [] for type_name in type_names}
+        sofa_id = None
+        members = {}
+
+        wanted_tags = list(tags) + [self.SOFA_TAG, self.VIEW_TAG]
+        for _, elem in etree.iterparse(xmi_file, events=("end",), tag=wanted_tags, huge_tree=True):
+            parent = elem.getparent()
+            if parent is None or parent.getparent() is not None:
+                # only direct children of the root are feature structures
+                continue
+
+            if elem.tag in tags:
+                type_name, parsers = tags[elem.tag]
+                features = dict.fromkeys(parsers)
+                for name, value in elem.attrib.items():
+                    if name == self.XMI_ID:
+                        features["xmiID"] = int(value)
+                    elif name in parsers:
+                        features[name] = parsers[name](value)
+                features_by_type[type_name].append(features)
+            elif elem.tag == self.SOFA_TAG:
+                if elem.get("sofaID") == "_InitialView":
+                    sofa_id = int(elem.get(self.XMI_ID))
+                    self.sofa_string = elem.get("sofaString")
+            elif elem.tag == self.VIEW_TAG:
+                members[int(elem.get("sofa"))] = {
+                    int(e) for e in elem.get("members", "").split()
+                }
+
+            # also frees the skipped elements before this one
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+
+        # annotations are indexed in the view of their sofa, with UTF-16 offsets
+        view_members = members.get(sofa_id, set())
+        to_python = self._offset_mapping()
+        for type_name, all_features in features_by_type.items():
+            annotations = []
+            for features in all_features:
+                if features["xmiID"] not in view_members:
+                    continue
+                features["begin"] = to_python(features["begin"])
+                features["end"] = to_python(features["end"])
+                annotations.append(XmiAnnotation(self, features))
+            annotations.sort(key=lambda ann: (ann.begin, ann.end, ann.xmiID))
+            self._annotations[type_name] = annotations
+            self._keys[type_name] = [(ann.begin, ann.end, ann.xmiID) for ann in annotations]
+
+    @staticmethod
+    def _feature_parsers(typesystem: TypeSystem, type_name: str) -> Dict[str, Callable[[str], object]]:
+        """Return the function converting the XMI value of each primitive feature of a type."""
+        parsers = {}
+        for feature in typesystem.get_type(type_name).all_features:
+            range_type = feature.rangeType.name
+            if range_type in ["uima.cas.Integer", "uima.cas.Short", "uima.cas.Long", "uima.cas.Byte"]:
+                parsers[feature.name] = int
+            elif range_type in ["uima.cas.Float", "uima.cas.Double"]:
+                parsers[feature.name] = float
+            elif range_type == "uima.cas.Boolean":
+                parsers[feature.name] = XmiAnnotations._parse_bool
+            elif range_type == "uima.cas.String":
+                parsers[feature.name] = str
+        # the sofa is a reference, but only its id is needed here
+        parsers["sofa"] = int
+        return parsers
+
+    @staticmethod
+    def _parse_bool(value: str) -> bool:
+        if value == "true":
+            return True
+        if value == "false":
+            return False
+        raise ValueError(f"Not a boolean: {value}")
+
+    def _offset_mapping(self) -> Callable[[int], int]:
+        """Return the function mapping UTF-16 offsets to offsets in `sofa_string`."""
+        text = self.sofa_string
+        if text is None or len(text.encode("utf-16-le")) == 2 * len(text):
+            # no character outside the BMP, offsets are the same
+            return lambda offset: offset
+        converter = Utf16CodepointOffsetConverter()
+        converter.create_offset_mapping(text)
+        return converter.external_to_python
+
+    def select(self, type_name: str) -> List[XmiAnnotation]:
+        """Return the annotations of a type, sorted by offsets.
+
+        :param str type_name: full name of the type.
+        :return: The annotations.
+        :rtype: List[XmiAnnotation]
+
+        """
+        return list(self._annotations[type_name])
+
+    def select_covered(self, type_name: str, covering_annotation) -> List[XmiAnnotation]:
+        """Return the annotations of a type within the offsets of `covering_annotation`.
+
+        :param str type_name: full name of the type.
+        :param covering_annotation: annotation whose offsets delimit the selection.
+        :return: The covered annotations, sorted by offsets.
+        :rtype: List[XmiAnnotation]
+
+        """
+        begin, end = covering_annotation.begin, covering_annotation.end
+        keys = self._keys[type_name]
+        lo = bisect_left(keys, (begin, begin))
+        hi = bisect_right(keys, (end, end))
+        return [
+            ann
+            for ann in self._annotations[type_name][lo:hi]
+            if ann.begin >= begin and ann.end <= end
+        ]
+
+
+def read_xmi(
+    xmi_file: str,
+    xml_file: str,
+    sanity_check: bool = True,
+    cache_dir: Optional[str] = None,
+    fast: bool = False,
+) -> AjmcDocument:
     """Parse CAS/XMI document.
 
     :param str xmi_file: path to xmi_file.
     :param str xml_file: path to xml schema file.
     :param bool sanity_check: Perform annotation-independent sanity check.
+    :param str cache_dir: folder of the parsed document cache. If given, a document
+        whose XMI and schema are unchanged is loaded from there instead of parsed.
+    :param bool fast: read only the annotations needed here with `XmiAnnotations`
+        instead of building the full CAS with cassis.
     :return: A namedtuple with all the annotation information.
     :rtype: AjmcDocument
 
@@ -97,20 +582,37 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDoc
     filepath = str(f_xmi)
     docid = filename.split(".")[0]
 
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir, f"{document_cache_key(xmi_file, xml_file, fast)}.pickle"
+        )
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                document = pickle.load(f)
+            # the same content may have been cached from another path
+            return document._replace(id=docid, filename=filename, filepath=filepath)
+
     segments = OrderedDict()
     links = {}
     hyphenated_words = []
-    mentions = OrderedDict()
 
-    with open(xml_file, "rb") as f:
-        typesystem = load_typesystem(f)
+    typesystem = get_typesystem(xml_file)
 
-    with open(xmi_file, "rb") as f:
-        cas = load_cas_from_xmi(f, typesystem=typesystem)
+    if fast:
+        cas = XmiAnnotations(
+            xmi_file, typesystem, [hyphenationType, sentenceType, tokenType, neType]
+        )
+    else:
+        with open(xmi_file, "rb") as f:
+            cas = load_cas_from_xmi(f, typesystem=typesystem)
 
     #if sanity_check:
     #    check_entity_boundaries(cas.select(neType), tokenType, cas, filename)
 
+    # tokens and mentions are added to struct-of-arrays tables as they are read
+    token_table = TokenTable(cas.sofa_string)
+    mention_table = MentionTable(cas.sofa_string)
+
     for hyphenation_annotation in cas.select(hyphenationType):
         hyphenated_words.append({
             "id": hyphenation_annotation.xmiID,
@@ -121,22 +623,18 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDoc
 
     # read in the tokens from golden sentences
     for seg in cas.select(sentenceType):
-        tokens = []
+        first_token = len(token_table)
         for tok in cas.select_covered(tokenType, seg):
             # ignore empty tokens
             if not tok.get_covered_text():
                 continue
             try:
-                token = {
-                    "id": tok.xmiID,
-                    "ann_layer": tokenType,
-                    "start_offset": tok.begin,
-                    "end_offset": tok.end,
-                    "surface": tok.get_covered_text(),
-                    "segment_id": seg.xmiID,
-                }
-
-                tokens.append(token)
+                token_table.append(
+                    id=tok.xmiID,
+                    start_offset=tok.begin,
+                    end_offset=tok.end,
+                    segment_id=seg.xmiID,
+                )
             except Exception as e:
                 msg = f"Problem with token annotation {tok.xmiID} in {xmi_file}"
                 logging.error(msg)
@@ -145,7 +643,7 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDoc
             "segment_id": seg.xmiID,
             "start_offset": seg.begin,
             "end_offset": seg.end,
-            "tokens": tokens,
+            "tokens": RecordList(token_table, first_token, len(token_table)),
             "corrupted": seg.corrupted,
             "incomplete_continuing": seg.incomplete_continuing,
             "incomplete_truncated": seg.incomplete_truncated
@@ -193,7 +691,7 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDoc
             else:
                 entity["levenshtein_norm"] = 0
 
-            mentions[ent.xmiID] = entity
+            mention_table.append(**entity)
 
             # read in the impresso links of named entity
             link = {
@@ -211,6 +709,10 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDoc
             #raise e
             #pdb.set_trace()
 
+    token_table.freeze()
+    mention_table.freeze()
+    mentions = RecordMapping(mention_table)
+
     document = AjmcDocument(
         docid,
         filename,
@@ -222,8 +724,32 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> AjmcDoc
         cas.sofa_string,
     )
 
+    if cache_dir:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(document, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
     return document
 
+
+def document_cache_key(xmi_file: str, xml_file: str, fast: bool = False) -> str:
+    """Computes the key of a document in the parsed document cache of `read_xmi`.
+
+    The key changes whenever the XMI file, the schema or the code of this module change.
+    Documents read with cassis and with `XmiAnnotations` are cached separately.
+
+    :param str xmi_file: path to xmi_file.
+    :param str xml_file: path to xml schema file.
+    :param bool fast: whether the document is read with `XmiAnnotations`.
+    :return: The cache key.
+    :rtype: str
+    """
+    reader = "lxml" if fast else "cassis"
+    key = "".join([hash_file(xmi_file), hash_file(xml_file), MODULE_HASH, reader])
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
 def read_annotation_assignments(filename: str, input_dir: str) -> pd.DataFrame:
     """Reads a CSV export of annotation assignment spreadsheet into a DataFrame.
 
@@ -246,4 +772,85 @@ def read_annotation_assignments(filename: str, input_dir: str) -> pd.DataFrame:
     df['split'] = df['split'].map(lambda x: x.replace('-',''))
     df['lang'] = df['lang'].map(lambda x: x.strip())
     df['Path'] = df.apply(derive_document_path, input_dir=input_dir, axis=1)
-    return df
\ No newline at end of file
+    return df
+
+
+def hash_file(path: str) -> Optional[str]:
+    """Computes the SHA-1 hash of the content of a file.
+
+    :param str path: path to the file.
+    :return: The hex digest, or None if the file does not exist.
+    :rtype: Optional[str]
+    """
+    if not os.path.exists(path):
+        return None
+
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# version of the code of this module, see `document_cache_key`
+MODULE_HASH = hash_file(__file__)
+
+
+class BuildManifest:
+    """Records what each output of a pipeline stage was built from.
+
+    The manifest is a JSON sidecar mapping each output path to the content hashes
+    of its inputs (e.g. XMI file and schema) and to the version of the code of
+    the stage, so that outputs whose inputs did not change can be skipped when
+    rebuilding. Deleting the manifest forces a full rebuild.
+    """
+
+    def __init__(self, path: str, code_files: List[str]):
+        """Load the manifest (if it exists).
+
+        :param str path: path to the JSON manifest file.
+        :param list code_files: source files of the stage; a change to any of them invalidates all outputs.
+        :return: None
+        :rtype: None
+
+        """
+        self.path = path
+        self.code_version = hashlib.sha1(
+            "".join(hash_file(f) for f in code_files).encode("utf-8")
+        ).hexdigest()
+
+        self.records = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.records = json.load(f)
+
+    def fingerprint(self, inputs: List[str], **options) -> dict:
+        """Compute the fingerprint of an output built from `inputs` (order matters) with `options`."""
+        return {
+            "inputs": [[str(path), hash_file(path)] for path in inputs],
+            "options": options,
+            "code_version": self.code_version,
+        }
+
+    def is_up_to_date(self, output: str, fingerprint: dict) -> bool:
+        """Whether `output` exists and was built from inputs with the same fingerprint."""
+        record = self.records.get(str(output))
+        if record is None or not os.path.exists(output):
+            return False
+        return all(record.get(key) == value for key, value in fingerprint.items())
+
+    def get(self, output: str) -> dict:
+        """Return the record of `output`, including any extra information stored with it."""
+        return self.records[str(output)]
+
+    def update(self, output: str, fingerprint: dict, **info) -> None:
+        """Record that `output` was built from inputs with `fingerprint`, plus extra information."""
+        self.records[str(output)] = dict(fingerprint, **info)
+
+    def save(self) -> None:
+        """Write the manifest to disk (atomically)."""
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.records, f, indent=1, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
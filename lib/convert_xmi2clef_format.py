@@ -9,16 +9,22 @@ import pandas
 from audioop import reverse
 import ipdb
 import json
-from typing import Dict, Generator, List, Tuple
+from typing import Dict, Generator, Iterator, List, Tuple
 import argparse
 import logging
+import logging.handlers
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import csv
 from collections import OrderedDict
 from tqdm import tqdm
 from typing import NamedTuple
 
-from ajmc_utils import AjmcDocument, read_xmi, METADATA, HYPHENS
+import ajmc_utils
+import impresso.helpers
+import impresso.helpers.xmi
+from ajmc_utils import AjmcDocument, BuildManifest, OffsetIndex, read_xmi, METADATA, HYPHENS
 from impresso.helpers import compute_levenshtein_distance
 
 from cassis import Cas, load_cas_from_xmi, load_typesystem
@@ -49,6 +55,15 @@ DATASET_VERSION = 'v0.4'
 
 NON_LINKABLE_ENTITY_TYPES = ['scope', 'date', 'object']
 
+# source files of the code converting a document, a change to any of them
+# invalidates all converted files in the build manifest
+CODE_FILES = [
+    __file__,
+    ajmc_utils.__file__,
+    impresso.helpers.__file__,
+    impresso.helpers.xmi.__file__,
+]
+
 def parse_args():
     """Parse the arguments given with program call"""
 
@@ -103,6 +118,41 @@ def parse_args():
         "--drop_nested", action="store_true", help="drop information in nested column",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        action="store",
+        dest="jobs",
+        help="number of worker processes converting files in parallel",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        action="store",
+        default=None,
+        dest="f_manifest",
+        help="path to a build manifest (JSON); files whose input and schema are unchanged are skipped",
+    )
+
+    parser.add_argument(
+        "-c",
+        "--cache_dir",
+        action="store",
+        default=None,
+        dest="cache_dir",
+        help="folder of the parsed document cache, to avoid parsing unchanged xmi files again",
+    )
+
+    parser.add_argument(
+        "--fast_xmi",
+        action="store_true",
+        dest="fast_xmi",
+        help="stream the needed annotations from the xmi files with lxml instead of loading them with cassis",
+    )
+
     return parser.parse_args()
 
 
@@ -119,38 +169,29 @@ def index_inception_files(dir_data, suffix=".xmi") -> list:
     return sorted([path for path in Path(dir_data).rglob("*" + suffix)])
 
 
-def lookup_hyphenation(tok: dict, hyphenated_words: list, doc: AjmcDocument) -> Tuple:
-    for word in hyphenated_words:
-        if tok["start_offset"] <= word["start_offset"] < tok["end_offset"]:
-            return (True, word['surface'])
-        elif word["start_offset"] <= tok["start_offset"] < word["end_offset"]:
-            return (True, word['surface'])
+def lookup_hyphenation(tok: dict, hyphenated_words: OffsetIndex, doc: AjmcDocument) -> Tuple:
+    matches = hyphenated_words.lookup(tok["start_offset"], tok["end_offset"])
+    if matches:
+        _, word = matches[0]
+        return (True, word['surface'])
     return (False, None)
 
 
-def lookup_entity(tok: dict, mentions: dict, doc: AjmcDocument) -> Tuple:
+def lookup_entity(tok: dict, mentions: OffsetIndex, doc: AjmcDocument) -> Tuple:
     """Get the respective IOB-label of a named entity (NE).
 
     :param dict tok: Annotation of the token.
-    :param dict mentions: Collections of annotated named entities.
+    :param OffsetIndex mentions: Index of the annotated named entities.
     :param ImpressoDocument doc: Document with all the annotation information.
     :return: Nested Tuple comprising the entity with the longest span and the respective entity labels (coarse, fine_1, comp, literal, fine_2).
     :rtype: Tuple
 
     """
 
-    matches = []
-
-    for ent in mentions.values():
-        if tok["start_offset"] <= ent["start_offset"] < tok["end_offset"]:
-            # start of entity
-            # entity may not match token boundaries
-            # i.e. start/end in the middle of a token
-            matches.append(("B", ent))
-        elif ent["start_offset"] <= tok["start_offset"] < ent["end_offset"]:
-            # token is part of an entity
-            # inside of entity
-            matches.append(("I", ent))
+    # entities starting within the token are marked as "B"
+    # (they may not match token boundaries, i.e. start/end in the middle of a token),
+    # entities the token is part of as "I"
+    matches = mentions.lookup(tok["start_offset"], tok["end_offset"])
 
     # sort by the begin of the span and then by longest span
     # thus, the first match spans potential other matches
@@ -393,28 +434,50 @@ def extract_noisy_entities(doc: AjmcDocument):
     return entities
 
 
-def convert_data(doc: AjmcDocument, drop_nested: bool) -> List:
+def convert_data(doc: AjmcDocument, drop_nested: bool) -> Tuple[List, List]:
     """Select the relevant annotations per token for the finegrained format.
 
-    :param ImpressoDocument doc: Document with all the annotation information.
+    :param AjmcDocument doc: Document with all the annotation information.
     :param bool drop_nested: Drop annotation of nested entities and replace with underscore.
-    :return: A nested list of tokens and its annotations.
-    :rtype: [list]
+    :return: Nested lists of tokens and their annotations, without and with the bibliographic layer.
+    :rtype: Tuple[List, List]
 
     """
 
     rows = []
     biblio_rows = []
 
-    document_metadata = get_document_metadata(doc)
-    rows += document_metadata
-    biblio_rows += document_metadata
+    for row, biblio_row in iter_data(doc, drop_nested):
+        rows.append(row)
+        biblio_rows.append(biblio_row)
+
+    return rows, biblio_rows
+
+
+def iter_data(doc: AjmcDocument, drop_nested: bool) -> Iterator[Tuple[List, List]]:
+    """Select the relevant annotations per token for the finegrained format, one token at a time.
+
+    :param AjmcDocument doc: Document with all the annotation information.
+    :param bool drop_nested: Drop annotation of nested entities and replace with underscore.
+    :return: The rows of the document metadata and then of each token, without and with the bibliographic layer.
+    :rtype: Iterator[Tuple[List, List]]
+
+    """
+
+    for row in get_document_metadata(doc):
+        yield row, row
 
     if len(doc.sentences.values()) <= 1:
         logging.warning(f"Document {doc.id} suspiciously contains 0 sentences")
 
+    mention_index = OffsetIndex(list(doc.mentions.values()))
+    hyphenation_index = OffsetIndex(doc.hyphenated_words)
+
     for i_seg, seg in enumerate(doc.sentences.values()):
 
+        # read the tokens of the segment out of the token table once
+        seg = dict(seg, tokens=list(seg["tokens"]))
+
         is_prev_token_hyphenated = False
 
         if seg['corrupted']:
@@ -424,8 +487,8 @@ def convert_data(doc: AjmcDocument, drop_nested: bool) -> List:
 
         for i_tok, tok in enumerate(seg["tokens"]):
 
-            literals, non_literals, biblio = lookup_entity(tok, doc.mentions, doc)
-            is_hyphenated, hyphenated_form = lookup_hyphenation(tok, doc.hyphenated_words, doc)
+            literals, non_literals, biblio = lookup_entity(tok, mention_index, doc)
+            is_hyphenated, hyphenated_form = lookup_hyphenation(tok, hyphenation_index, doc)
 
             token_surface = tok["surface"]
 
@@ -524,14 +587,79 @@ def convert_data(doc: AjmcDocument, drop_nested: bool) -> List:
                 misc,
             ]
 
-            rows.append(row)
-            biblio_rows.append(biblio_row)
-    #ipdb.set_trace()
-    return rows, biblio_rows
+            yield row, biblio_row
+
+
+def convert_file(
+    f_xmi: Path,
+    f_tsv: Path,
+    f_biblio_tsv: Path,
+    f_schema: str,
+    drop_nested: bool = False,
+    cache_dir: str = None,
+    fast_xmi: bool = False,
+) -> List[Dict]:
+    """Convert a single xmi file into its TSV and biblio TSV files.
+
+    :param Path f_xmi: Path to the .xmi-file.
+    :param Path f_tsv: Path to the output .tsv-file.
+    :param Path f_biblio_tsv: Path to the output .tsv-file with the bibliographic layer.
+    :param str f_schema: Path to the .XML-file of the schema.
+    :param bool drop_nested: Drop annotation of nested entities and replace with underscore.
+    :param str cache_dir: Folder of the parsed document cache.
+    :param bool fast_xmi: Read the xmi file with `XmiAnnotations` rather than cassis.
+    :return: The noisy entities found in the document.
+    :rtype: List[Dict]
+
+    """
+
+    info_msg = f"Converting {f_xmi} into {f_tsv}"
+    logging.info(info_msg)
+
+    doc = read_xmi(f_xmi, f_schema, sanity_check=False, cache_dir=cache_dir, fast=fast_xmi)
+    f_tsv.parent.mkdir(parents=True, exist_ok=True)
+
+    noisy_entities = extract_noisy_entities(doc)
+
+    # rows are written as the tokens are converted, to temporary files
+    # that only replace the previous output once the document is complete
+    f_tsv_tmp = f_tsv.with_name(f_tsv.name + ".tmp")
+    f_biblio_tsv_tmp = f_biblio_tsv.with_name(f_biblio_tsv.name + ".tmp")
+
+    with f_tsv_tmp.open("w") as tsvfile, f_biblio_tsv_tmp.open("w") as biblio_tsvfile:
+        writer = csv.writer(tsvfile, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
+        biblio_writer = csv.writer(biblio_tsvfile, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
+        writer.writerow(COL_LABELS)
+        biblio_writer.writerow(COL_LABELS)
+
+        for row, biblio_row in iter_data(doc, drop_nested):
+            writer.writerow(row)
+            biblio_writer.writerow(biblio_row)
+
+    os.replace(f_tsv_tmp, f_tsv)
+    os.replace(f_biblio_tsv_tmp, f_biblio_tsv)
+
+    return noisy_entities
+
+
+def init_worker(log_queue: multiprocessing.Queue):
+    """Send the log records of a worker process to the main process through `log_queue`."""
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
 
 
 def start_batch_conversion(
-    dir_in: str, dir_out: str, f_schema: str, coref: bool = False, drop_nested: bool = False
+    dir_in: str,
+    dir_out: str,
+    f_schema: str,
+    coref: bool = False,
+    drop_nested: bool = False,
+    jobs: int = 1,
+    f_manifest: str = None,
+    cache_dir: str = None,
+    fast_xmi: bool = False,
 ):
     """Start a batch conversion of xmi files in the given folder .
 
@@ -540,6 +668,10 @@ def start_batch_conversion(
     :param str f_schema: Path to the .XML-file of the schema.
     :param bool coref: Add information of coreference cluster (not yet implemented).
     :param bool drop_nested: Drop annotation of nested entities and replace with underscore.
+    :param int jobs: Number of worker processes converting files in parallel.
+    :param str f_manifest: Path to the build manifest, to skip files whose inputs are unchanged.
+    :param str cache_dir: Folder of the parsed document cache.
+    :param bool fast_xmi: Read the xmi files with `XmiAnnotations` rather than cassis.
     :return: None.
     :rtype: None
 
@@ -550,35 +682,81 @@ def start_batch_conversion(
     dir_base = os.path.join(*dir_out.split('/')[:3])
     tsv_files = [Path(str(p).replace(dir_in, dir_out)).with_suffix(".tsv") for p in xmi_files]
     tsv_biblio_files = [Path(str(f).replace('.tsv', '-biblio.tsv')) for f in tsv_files]
+    all_tsv_files = tsv_files
+
+    # noisy entities of each document, by TSV file
+    doc_noisy_entities = {}
+
+    if f_manifest:
+        manifest = BuildManifest(f_manifest, CODE_FILES)
+        fingerprints = {
+            f_tsv: manifest.fingerprint([f_xmi, f_schema], drop_nested=drop_nested)
+            for f_xmi, f_tsv in zip(xmi_files, tsv_files)
+        }
+
+        changed_files = []
+        for f_xmi, f_tsv, f_biblio_tsv in zip(xmi_files, tsv_files, tsv_biblio_files):
+            if manifest.is_up_to_date(f_tsv, fingerprints[f_tsv]) and f_biblio_tsv.exists():
+                doc_noisy_entities[f_tsv] = manifest.get(f_tsv)["noisy_entities"]
+            else:
+                changed_files.append((f_xmi, f_tsv, f_biblio_tsv))
+
+        xmi_files = [f_xmi for f_xmi, _, _ in changed_files]
+        tsv_files = [f_tsv for _, f_tsv, _ in changed_files]
+        tsv_biblio_files = [f_biblio_tsv for _, _, f_biblio_tsv in changed_files]
+        logging.info(f"Skipped {len(doc_noisy_entities)} unchanged files.")
+
     msg = f"Start conversion of {len(xmi_files)} files."
     logging.info(msg)
     print(msg)
 
-    noisy_entities = []
-
-    for f_xmi, f_tsv, f_biblio_tsv in tqdm(list(zip(xmi_files, tsv_files, tsv_biblio_files))):
+    if jobs > 1:
+        # workers log through a queue, which is emptied into
+        # the handlers (i.e. the log file) of the main process
+        log_queue = multiprocessing.Queue()
+        log_listener = logging.handlers.QueueListener(
+            log_queue, *logging.getLogger().handlers, respect_handler_level=True
+        )
+        log_listener.start()
 
-        info_msg = f"Converting {f_xmi} into {f_tsv}"
-        logging.info(info_msg)
-
-        doc = read_xmi(f_xmi, f_schema, sanity_check=False)
-        f_tsv.parent.mkdir(parents=True, exist_ok=True)
-
-        noisy_entities += extract_noisy_entities(doc)
+        try:
+            with ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_worker, initargs=(log_queue,)
+            ) as executor:
+                # results come back in file order, whichever worker finishes first
+                results = executor.map(
+                    convert_file,
+                    xmi_files,
+                    tsv_files,
+                    tsv_biblio_files,
+                    [f_schema] * len(xmi_files),
+                    [drop_nested] * len(xmi_files),
+                    [cache_dir] * len(xmi_files),
+                    [fast_xmi] * len(xmi_files),
+                )
+                for f_tsv, result in tqdm(zip(tsv_files, results), total=len(xmi_files)):
+                    doc_noisy_entities[f_tsv] = result
+        finally:
+            log_listener.stop()
 
-        data, biblio_data = convert_data(doc, drop_nested)
+    else:
+        for f_xmi, f_tsv, f_biblio_tsv in tqdm(list(zip(xmi_files, tsv_files, tsv_biblio_files))):
+            doc_noisy_entities[f_tsv] = convert_file(
+                f_xmi, f_tsv, f_biblio_tsv, f_schema, drop_nested, cache_dir, fast_xmi
+            )
 
-        with f_tsv.open("w") as tsvfile:
-            writer = csv.writer(tsvfile, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
-            writer.writerow(COL_LABELS)
-            writer.writerows(data)
+    logging.info(f"Conversion completed.")
 
-        with f_biblio_tsv.open("w") as tsvfile:
-            writer = csv.writer(tsvfile, delimiter="\t", quoting=csv.QUOTE_NONE, quotechar="")
-            writer.writerow(COL_LABELS)
-            writer.writerows(biblio_data)
+    if f_manifest:
+        for f_tsv in tsv_files:
+            manifest.update(
+                f_tsv, fingerprints[f_tsv], noisy_entities=doc_noisy_entities[f_tsv]
+            )
+        manifest.save()
 
-    logging.info(f"Conversion completed.")
+    noisy_entities = []
+    for f_tsv in all_tsv_files:
+        noisy_entities += doc_noisy_entities[f_tsv]
 
     if len(noisy_entities) > 0:
             noisy_entities_df = pandas.DataFrame(noisy_entities)
@@ -597,7 +775,16 @@ def main():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
 
-    start_batch_conversion(args.dir_in, args.dir_out, args.f_schema, args.drop_nested)
+    start_batch_conversion(
+        args.dir_in,
+        args.dir_out,
+        args.f_schema,
+        args.drop_nested,
+        jobs=args.jobs,
+        f_manifest=args.f_manifest,
+        cache_dir=args.cache_dir,
+        fast_xmi=args.fast_xmi,
+    )
 
 
 ################################################################################
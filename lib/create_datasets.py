@@ -2,27 +2,97 @@
 ...
 
 Usage:
-    lib/create_datasets.py --set=<set> --log-file=<log> --input-dir=<id> --output-dir=<od> --data-version=<v> --assignments-table=<at>
+    lib/create_datasets.py --set=<set> --log-file=<log> --input-dir=<id> --output-dir=<od> --data-version=<v> --assignments-table=<at> [--manifest=<m>] [--jobs=<j>]
+
+Options:
+    --manifest=<m>  Path to a build manifest (JSON); release files whose input files are unchanged are skipped.
+    --jobs=<j>      Number of worker processes building release files in parallel [default: 1].
 """  # noqa
 
 from docopt import docopt
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import logging
+import logging.handlers
+import multiprocessing
 import os
+import shutil
+import tempfile
+import time
 import ipdb
 import pandas as pd
 import random
-from typing import List
-from ajmc_utils import read_annotation_assignments
-from hipe_commons.helpers.tsv import is_tsv_complete, write_tsv, parse_tsv
+from typing import Callable, Dict, List, NamedTuple, Optional
+from ajmc_utils import BuildManifest, read_annotation_assignments
+from hipe_commons.helpers.tsv import write_tsv, parse_tsv
+from impresso.helpers.tsv import INDEX_SUFFIX, ColumnarTSV, TSVIndexEntry, write_tsv_index
 
 LOGGER = logging.getLogger(__name__)
 
 DATASET_NAME = "ajmc"
 
-def concat_tsv_files(output_path: str, input_files: List[str]) -> None:
+# source files of the code building the release, a change to any of them invalidates
+# all release files in the build manifest
+CODE_FILES = [
+    __file__,
+    read_annotation_assignments.__code__.co_filename,
+    write_tsv_index.__code__.co_filename,
+]
+
+TSVDocumentOffset = NamedTuple(
+    "TSVDocumentOffset",
+    [
+        ("document_id", str),
+        ("path", str),
+        ("line", int),
+        ("offset", int),
+        ("length", int),
+        ("n_tokens", int),
+        ("comments", Dict[str, str]),
+    ],
+)
+
+ReleaseArtifact = NamedTuple(
+    "ReleaseArtifact",
+    [
+        ("output_path", str),
+        ("build", Callable),
+        ("kwargs", Dict),
+        ("inputs", Optional[List[str]]),
+        ("outputs", List[str]),
+    ],
+)
+
+
+def concat_tsv_files(output_path: str, input_files: List[str]) -> List[TSVDocumentOffset]:
+    """Concatenate document TSV files into a single TSV file, one line at a time.
+
+    Only the header line of the first file is kept, and files are separated by an
+    empty line. The document IDs of the metadata comments are collected while
+    copying, so that the output does not need to be read again to check it.
+
+    :param str output_path: Path to the concatenated TSV file.
+    :param list input_files: Paths to the document TSV files, missing files are skipped.
+    :return: The documents found, with the line number (from 1), byte offset and
+        byte length of the content of their file in the output, its number of
+        token lines and its metadata comments.
+    :rtype: List[TSVDocumentOffset]
+
+    """
+    documents = []
+    line_number = 1
+    offset = 0
+
     with open(output_path, "w") as out_tsv_file:
-        data = []
+        encoding = out_tsv_file.encoding
+
+        def write(text: str) -> None:
+            nonlocal line_number, offset
+            out_tsv_file.write(text)
+            line_number += text.count("\n")
+            offset += len(text.encode(encoding))
+
+        is_first_file = True
         for n, file in enumerate(input_files):
 
             if not os.path.exists(file):
@@ -31,14 +101,59 @@ def concat_tsv_files(output_path: str, input_files: List[str]) -> None:
 
             LOGGER.info(f"Read input from file {file}")
 
+            if not is_first_file:
+                write("\n")
+            is_first_file = False
+
             with open(file, "r") as inp_tsv_file:
-                if n > 0:
-                    lines = inp_tsv_file.readlines()[1:]
-                else:
-                    lines = inp_tsv_file.readlines()[0:]
-                data.append("".join(lines))
+                header = inp_tsv_file.readline()
+                if n == 0:
+                    write(header)
+
+                line, start = line_number, offset
+                document_ids = []
+                comments = {}
+                n_tokens = 0
+                for tsv_line in inp_tsv_file:
+                    if tsv_line.startswith("#") and "=" in tsv_line:
+                        field, _, value = tsv_line.replace("#", "").partition("=")
+                        comments[field.strip()] = value.strip()
+                        if "document_id" in tsv_line:
+                            document_ids.append(tsv_line.strip().split("=")[-1].strip())
+                    elif tsv_line.strip():
+                        n_tokens += 1
+                    write(tsv_line)
+
+                # each document TSV file contains a single document
+                for document_id in document_ids:
+                    documents.append(
+                        TSVDocumentOffset(
+                            document_id, file, line, start, offset - start, n_tokens, comments
+                        )
+                    )
+
+    return documents
+
+
+def is_concatenation_complete(
+    dataset_path: str, documents: List[TSVDocumentOffset], expected_doc_ids: List[str]
+) -> bool:
+    """Check that all expected documents were found by `concat_tsv_files`.
+
+    :param str dataset_path: Path to the concatenated TSV file.
+    :param list documents: Documents found when concatenating the TSV file.
+    :param list expected_doc_ids: IDs of the documents that should be in the TSV file.
+    :return: True if no expected document is missing.
+    :rtype: bool
+
+    """
+    difference = set(expected_doc_ids).difference(doc.document_id for doc in documents)
+
+    if difference:
+        print(f"Following documents are missing from {dataset_path}: {difference}")
+        return False
+    return True
 
-        out_tsv_file.write("\n".join(data))
 
 def create_entity_ocr_mapping_file(input_path, output_path, language, annotation_assignments_df):
 
@@ -80,16 +195,24 @@ def create_entity_ocr_mapping_file(input_path, output_path, language, annotation
         ascending=False
     ).to_csv(output_path, sep="\t", index=False)
 
-def create_datasets(input_dir, output_dir, version, assignments_table_path, set="all"):
+def create_datasets(
+    input_dir,
+    output_dir,
+    version,
+    assignments_table_path,
+    set="all",
+    manifest_path=None,
+    jobs=1,
+):
     
     splits = ["train", "dev", "test"]
     langs = ["en", "de", "fr"]
+    manifest = BuildManifest(manifest_path, CODE_FILES) if manifest_path else None
 
     assignments_df = read_annotation_assignments(assignments_table_path, input_dir)
     basedir = os.path.join(output_dir, version)
-    if not os.path.exists(basedir):
-        LOGGER.info(f"Created folder {basedir} as it did not exist")
-        Path(basedir).mkdir(exist_ok=True)
+
+    artifacts = []
 
     for lang in langs:
 
@@ -100,12 +223,12 @@ def create_datasets(input_dir, output_dir, version, assignments_table_path, set=
                     & (assignments_df.lang == lang)
                 ].Path
             )
-            dataset_path = create_dataset(
-                document_paths, lang, set, version, output_dir
+            artifacts.append(
+                dataset_artifact(document_paths, lang, set, version, output_dir)
             )
 
-            biblio_dataset_path = create_dataset(
-                document_paths, lang, set, version, output_dir, biblio_layer=True
+            artifacts.append(
+                dataset_artifact(document_paths, lang, set, version, output_dir, biblio_layer=True)
             )
 
         else:
@@ -119,12 +242,12 @@ def create_datasets(input_dir, output_dir, version, assignments_table_path, set=
                         & (assignments_df.annotated == True)
                     ].Path
                 )
-                dataset_path = create_dataset(
-                    document_paths, lang, split, version, output_dir
+                artifacts.append(
+                    dataset_artifact(document_paths, lang, split, version, output_dir)
                 )
 
-                dataset_path = create_dataset(
-                    document_paths, lang, split, version, output_dir, biblio_layer=True
+                artifacts.append(
+                    dataset_artifact(document_paths, lang, split, version, output_dir, biblio_layer=True)
                 )
                     
 
@@ -134,28 +257,71 @@ def create_datasets(input_dir, output_dir, version, assignments_table_path, set=
             noisy_entities_mapping_path = os.path.join(input_dir, "corpus", noisy_entities_mapping_fname)
             noisy_entities_mapping_release_path = os.path.join(output_dir, version, noisy_entities_mapping_fname)
             
-            create_entity_ocr_mapping_file(
-                noisy_entities_mapping_path,
-                noisy_entities_mapping_release_path,
-                lang,
-                assignments_df
+            artifacts.append(
+                ReleaseArtifact(
+                    noisy_entities_mapping_release_path,
+                    create_entity_ocr_mapping_file,
+                    {
+                        "input_path": noisy_entities_mapping_path,
+                        "language": lang,
+                        "annotation_assignments_df": assignments_df,
+                    },
+                    None,
+                    [noisy_entities_mapping_release_path],
+                )
             )
 
-
-def create_dataset(
-    files: str, language: str, split: str, version: str, output_dir: str, biblio_layer : bool = False
-) -> str:
+    fingerprints = {}
+    if manifest:
+        changed_artifacts = []
+        for artifact in artifacts:
+            if artifact.inputs is not None:
+                fingerprint = manifest.fingerprint(artifact.inputs)
+                # a deleted sidecar (e.g. the index of a TSV file) is rebuilt as well
+                if manifest.is_up_to_date(artifact.output_path, fingerprint) and all(
+                    os.path.exists(path) for path in artifact.outputs
+                ):
+                    LOGGER.info(f"Skipped {artifact.output_path} as its input files are unchanged")
+                    continue
+                fingerprints[artifact.output_path] = fingerprint
+            changed_artifacts.append(artifact)
+        artifacts = changed_artifacts
+
+    build_release(artifacts, basedir, jobs)
+
+    if manifest:
+        for output_path, fingerprint in fingerprints.items():
+            manifest.update(output_path, fingerprint)
+        manifest.save()
+
+
+def dataset_artifact(
+    files: List[str],
+    language: str,
+    split: str,
+    version: str,
+    output_dir: str,
+    biblio_layer: bool = False,
+) -> ReleaseArtifact:
+    """Describe the release TSV file of a split of a language, see `create_dataset`.
+
+    :param list files: Paths to the TSV files of the documents of the split.
+    :param str language: Language of the documents.
+    :param str split: Name of the split.
+    :param str version: Version of the release.
+    :param str output_dir: Top-level folder of the releases.
+    :param bool biblio_layer: Release the bibliographic layer rather than the entities.
+    :return: The release artifact.
+    :rtype: ReleaseArtifact
+
+    """
     if biblio_layer:
         name = DATASET_NAME + "_biblio"
     else:
         name = DATASET_NAME
     
     tsv_filename = f"{name}-{version}-{split}-{language}.tsv"
-    
-    basedir = os.path.join(output_dir, version)
-
-    if not os.path.exists(basedir):
-        Path(basedir).mkdir(exist_ok=True)
+    output_path = os.path.join(output_dir, version, tsv_filename)
 
     assert len(files) > 0
 
@@ -165,25 +331,186 @@ def create_dataset(
             for file in files
         ]
 
+    return ReleaseArtifact(
+        output_path,
+        create_dataset,
+        {"files": files, "split": split, "biblio_layer": biblio_layer},
+        files,
+        dataset_output_paths(output_path),
+    )
+
+
+def dataset_output_paths(output_path: str) -> List[str]:
+    """Return the paths to the files written by `create_dataset` for a release TSV file.
+
+    :param str output_path: Path to the TSV file of the split.
+    :return: The TSV file, its index and its Parquet file.
+    :rtype: List[str]
+
+    """
+    return [
+        output_path,
+        output_path + INDEX_SUFFIX,
+        os.path.splitext(output_path)[0] + ".parquet",
+    ]
+
+
+def create_dataset(
+    files: List[str],
+    output_path: str,
+    split: str,
+    biblio_layer : bool = False,
+) -> str:
+    """Concatenate the TSV files of the documents of a split into a single TSV file.
+
+    The byte range of each document in the TSV file is written to an index sidecar
+    next to it (`INDEX_SUFFIX`), so that documents can be read with `TSVReader`,
+    and its lines to a Parquet file, see `ColumnarTSV.to_arrow`.
+
+    :param list files: Paths to the TSV files of the documents of the split.
+    :param str output_path: Path to the TSV file of the split.
+    :param str split: Name of the split.
+    :param bool biblio_layer: Whether the files contain the bibliographic layer.
+    :return: The path to the TSV file of the split.
+    :rtype: str
+
+    """
+
     # concatenate document TSV files into a single TSV
     # and write to disk in the specified output folder 
-    output_path = os.path.join(basedir, tsv_filename)
-    concat_tsv_files(output_path, files)
+    _, index_path, parquet_path = dataset_output_paths(output_path)
+    documents = concat_tsv_files(output_path, files)
     LOGGER.info(f"Written {split} to {output_path}")
 
+    # index the documents by their byte range in the TSV file, see `TSVReader`
+    write_tsv_index(
+        [
+            TSVIndexEntry(
+                doc.document_id,
+                doc.offset,
+                doc.length,
+                doc.n_tokens,
+                doc.document_id.split("_")[0],
+                doc.comments.get("ajmc:page", ""),
+                doc.comments.get("hipe2022:language", ""),
+            )
+            for doc in documents
+        ],
+        index_path,
+    )
+
+    # the same lines as a Parquet file, for loading splits without parsing TSV
+    ColumnarTSV.from_tsv(output_path).to_parquet(parquet_path)
+    LOGGER.info(f"Written {split} to {parquet_path}")
+
     if not biblio_layer:
         # verify that all documents expected are found in the
         # output TSV file
         expected_doc_ids = [
             os.path.basename(f).replace(".tsv", "") for f in files
         ]
-        assert is_tsv_complete(output_path, expected_doc_ids)
+        assert is_concatenation_complete(output_path, documents, expected_doc_ids)
         LOGGER.info(
             f"{output_path} contains all {len(expected_doc_ids)} expected documents"
         )
+
     return output_path
 
 
+def build_artifact(artifact: ReleaseArtifact, output_path: str) -> float:
+    """Build a release artifact into `output_path`.
+
+    :param ReleaseArtifact artifact: The artifact to build.
+    :param str output_path: Path to write the artifact to, instead of `artifact.output_path`.
+    :return: The time it took to build the artifact, in seconds.
+    :rtype: float
+
+    """
+    start = time.perf_counter()
+    artifact.build(output_path=output_path, **artifact.kwargs)
+    return time.perf_counter() - start
+
+
+def init_worker(log_queue: multiprocessing.Queue):
+    """Send the log records of a worker process to the main process through `log_queue`."""
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.DEBUG)
+
+
+def build_release(artifacts: List[ReleaseArtifact], basedir: str, jobs: int = 1) -> None:
+    """Build release artifacts, all or none of them.
+
+    Artifacts are built in a staging folder next to `basedir` and only moved into
+    `basedir` (along with any other file written next to them) once every one of
+    them was built, so that a failed build leaves the release folder as it was.
+
+    :param list artifacts: The artifacts to build, all in `basedir`.
+    :param str basedir: The release folder.
+    :param int jobs: Number of worker processes building artifacts in parallel.
+    :return: None
+    :rtype: None
+
+    """
+    Path(basedir).parent.mkdir(parents=True, exist_ok=True)
+    staging_dir = tempfile.mkdtemp(
+        prefix=f".{os.path.basename(basedir)}-", dir=Path(basedir).parent
+    )
+    staging_paths = [
+        os.path.join(staging_dir, os.path.basename(artifact.output_path)) for artifact in artifacts
+    ]
+
+    start = time.perf_counter()
+    try:
+        if jobs > 1:
+            # workers log through a queue, which is emptied into
+            # the handlers (i.e. the log file) of the main process
+            log_queue = multiprocessing.Queue()
+            log_listener = logging.handlers.QueueListener(
+                log_queue, *logging.getLogger().handlers, respect_handler_level=True
+            )
+            log_listener.start()
+
+            executor = ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_worker, initargs=(log_queue,)
+            )
+            try:
+                futures = {
+                    executor.submit(build_artifact, artifact, staging_path): artifact
+                    for artifact, staging_path in zip(artifacts, staging_paths)
+                }
+                for future in as_completed(futures):
+                    elapsed = future.result()
+                    LOGGER.info(f"Built {futures[future].output_path} in {elapsed:.2f}s")
+            finally:
+                executor.shutdown(wait=True, cancel_futures=True)
+                log_listener.stop()
+
+        else:
+            for artifact, staging_path in zip(artifacts, staging_paths):
+                elapsed = build_artifact(artifact, staging_path)
+                LOGGER.info(f"Built {artifact.output_path} in {elapsed:.2f}s")
+
+    except BaseException:
+        LOGGER.error(f"Release build failed, {basedir} is left unchanged")
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    if not os.path.exists(basedir):
+        LOGGER.info(f"Created folder {basedir} as it did not exist")
+        Path(basedir).mkdir(exist_ok=True)
+
+    # artifacts may come with other files, such as the index of a TSV file
+    for filename in os.listdir(staging_dir):
+        os.replace(os.path.join(staging_dir, filename), os.path.join(basedir, filename))
+    os.rmdir(staging_dir)
+
+    msg = f"Built {len(artifacts)} release files in {basedir} in {time.perf_counter() - start:.2f}s"
+    LOGGER.info(msg)
+    print(msg)
+
+
 def main(args):
     which_set = args["--set"]
     log_file = args["--log-file"]
@@ -191,6 +518,8 @@ def main(args):
     output_dir = args["--output-dir"]
     data_version = args["--data-version"]
     assignments_table = args["--assignments-table"]
+    manifest_path = args["--manifest"]
+    jobs = int(args["--jobs"])
 
     logging.basicConfig(
         filename=log_file,
@@ -202,7 +531,15 @@ def main(args):
     accepted_sets = ["all", "sample"]
     assert which_set in accepted_sets
 
-    create_datasets(input_dir, output_dir, data_version, assignments_table, which_set)
+    create_datasets(
+        input_dir,
+        output_dir,
+        data_version,
+        assignments_table,
+        which_set,
+        manifest_path,
+        jobs=jobs,
+    )
 
 
 if __name__ == "__main__":
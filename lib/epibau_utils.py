@@ -13,7 +13,8 @@ from pathlib import Path
 from collections import OrderedDict
 from tqdm import tqdm
 from typing import NamedTuple
-from cassis import Cas, load_cas_from_xmi, load_typesystem
+from cassis import Cas, load_cas_from_xmi
+from impresso.helpers.xmi import get_typesystem
 
 EpibauDocument = NamedTuple(
     "EpibauDocument",
@@ -57,8 +58,7 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> EpibauD
     relations = []
     mentions = OrderedDict()
 
-    with open(xml_file, "rb") as f:
-        typesystem = load_typesystem(f)
+    typesystem = get_typesystem(xml_file)
 
     with open(xmi_file, "rb") as f:
         cas = load_cas_from_xmi(f, typesystem=typesystem)
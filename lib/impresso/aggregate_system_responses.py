@@ -7,6 +7,9 @@ Leverage the system responses to spot potentially wrong annotations in the gold
 Whenever a majority of systems (or any other threshold) predicts another annotation
 as there is in the gold standard, it gets logged.
 
+System responses whose tokens differ from the gold standard are aligned to it
+document by document, and their unaligned tokens do not count as votes.
+
 Usage:
     lib/aggregate_system_responses.py --gold_file=<fpath> --input_dir=<id> --log_file=<log> [options]
 
@@ -16,17 +19,36 @@ Options:
     -i --input_dir=<id>     Input directory where the system responses are saved.
     -t --threshold=<float>  Log when system predicted the true label below this threshold [default:0.5]
     -l --log_file=<log>     Name of log file.
+    -j --jobs=<j>           Number of worker processes reading and aligning the system
+                            responses [default: 1].
+    -c --cache_dir=<cd>     Folder of a cache of parsed system responses, so that a re-run
+                            only parses the responses that changed (no cache by default).
 """
 
+import hashlib
+import io
 import logging
+import os
+import pickle
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from difflib import SequenceMatcher
+from functools import partial
 from pathlib import Path
 import csv
-from collections import OrderedDict
 
 import pandas as pd
 import numpy as np
 from docopt import docopt
 
+# columns that are not annotations, i.e. that are not compared with the system responses
+META_COLUMNS = {"index", "TOKEN", "MISC", "DOCUMENT_ID"}
+
+# largest number of token pairs of a range that `align_tokens` aligns with difflib
+MAX_MATCHER_CELLS = 250_000
+# largest number of nested ranges in which `align_tokens` looks for unique tokens
+MAX_ANCHOR_DEPTH = 4
+
 
 def index_files(dir_data, lang, suffix=".tsv") -> list:
     """Index all .tsv files for a specific language in the provided directory
@@ -45,20 +67,19 @@ def index_files(dir_data, lang, suffix=".tsv") -> list:
 def read_dataframe(f_sub: str) -> pd.DataFrame:
     """
     Read a a dataframe, filter out comments, and keep NEL best@1 only.
+    The document of each token is kept in the DOCUMENT_ID column.
     """
 
     df = pd.read_csv(f_sub, sep="\t", quoting=csv.QUOTE_NONE, quotechar="")
+    df["DOCUMENT_ID"] = document_ids(df.TOKEN)
     # remove any comments
     df = df[~df.TOKEN.str.startswith("# ", na=True)].reset_index()
 
     # keep NEL best@1 only
     try:
         df = df.fillna(value={"NE-COARSE-LIT": "", "NEL-LIT": "", "NEL-METO": ""})
-        df["NEL-LIT"] = df["NEL-LIT"].str.split("|").apply(lambda x: x[:1])
-        df["NEL-METO"] = df["NEL-METO"].str.split("|").apply(lambda x: x[:1])
-
-        df["NEL-METO"] = df["NEL-METO"].str.join("|")
-        df["NEL-LIT"] = df["NEL-LIT"].str.join("|")
+        df["NEL-LIT"] = df["NEL-LIT"].str.split("|", n=1).str[0]
+        df["NEL-METO"] = df["NEL-METO"].str.split("|", n=1).str[0]
 
     except KeyError:
         pass
@@ -66,6 +87,112 @@ def read_dataframe(f_sub: str) -> pd.DataFrame:
     return df
 
 
+def document_ids(tokens: pd.Series) -> pd.Series:
+    """
+    Document ID of each row, from the `document_id` comment preceding it (empty if there is none).
+    """
+
+    tokens = tokens.astype(object)
+    is_comment = tokens.str.startswith("# ", na=False)
+    is_id = is_comment & tokens.str.contains("document_id", regex=False, na=False)
+    ids = tokens.where(is_id).str.split("=").str[-1].str.strip()
+
+    return ids.ffill().fillna("")
+
+
+def parse_submission(content: bytes, columns: list) -> pd.DataFrame:
+    """
+    Parse a system response, keeping only the given columns as categoricals and NEL best@1 only.
+    Comment lines but the document IDs are dropped before parsing. The rows are the same as by
+    `read_dataframe`.
+    """
+
+    lines = [
+        line
+        for line in content.splitlines(keepends=True)
+        if not line.startswith(b"# ") or b"document_id" in line
+    ]
+    wanted = {"TOKEN", *columns}
+    df = pd.read_csv(
+        io.BytesIO(b"".join(lines)),
+        sep="\t",
+        quoting=csv.QUOTE_NONE,
+        usecols=lambda col: col in wanted,
+        dtype="category",
+    )
+    df["DOCUMENT_ID"] = document_ids(df.TOKEN).astype("category")
+    df = df[~df.TOKEN.str.startswith("# ", na=True)].reset_index(drop=True)
+
+    for col in ["NE-COARSE-LIT", "NEL-LIT", "NEL-METO"]:
+        if col not in df.columns:
+            continue
+        # work on the categories rather than on the rows, the last value is for missing labels
+        values = df[col].cat.categories.astype(str)
+        if col.startswith("NEL"):
+            values = values.str.split("|", n=1).str[0]
+        values = np.append(values.to_numpy(dtype=object), "")
+        df[col] = pd.Categorical(values[df[col].cat.codes.to_numpy()])
+
+    return df
+
+
+def submission_cache_key(content: bytes, columns: list) -> str:
+    """
+    Key of a system response in the cache of `load_submission`.
+    It changes whenever the file, the selected columns or the code of this module change.
+    """
+
+    digest = hashlib.sha1(content)
+    with open(__file__, "rb") as f:
+        digest.update(hashlib.sha1(f.read()).digest())
+    digest.update("\t".join(sorted(columns)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def load_submission(f_sub: str, columns: list, cache_dir: str = None) -> pd.DataFrame:
+    """
+    Read a system response with `parse_submission`.
+    If `cache_dir` is given, unchanged responses are loaded from there instead of being parsed
+    again.
+    """
+
+    with open(f_sub, "rb") as f:
+        content = f.read()
+
+    if cache_dir:
+        cache_path = os.path.join(cache_dir, f"{submission_cache_key(content, columns)}.pickle")
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+    df = parse_submission(content, columns)
+
+    if cache_dir:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    return df
+
+
+def load_submissions(
+    submissions: list, columns: list, jobs: int = 1, cache_dir: str = None
+) -> list:
+    """
+    Read the system responses with `load_submission`, in parallel when `jobs` is greater than 1.
+    The dataframes are returned in the order of `submissions`.
+    """
+
+    load = partial(load_submission, columns=columns, cache_dir=cache_dir)
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(load, submissions))
+
+    return [load(f_sub) for f_sub in submissions]
+
+
 def select_annotation(dfs_submission: list, col: str) -> list:
     """
     Filter dataframes and columns that have revevant data for a particular annotation type.
@@ -73,7 +200,8 @@ def select_annotation(dfs_submission: list, col: str) -> list:
     dfs_filtered = []
     for df in dfs_submission:
         try:
-            labels = set(df[col].unique())
+            # missing labels (e.g. tokens that could not be aligned) are not a label
+            labels = set(df[col].dropna().unique())
             labels = {label for label in labels if labels not in {"_", "O"}}
             if len(labels) > 1:
                 dfs_filtered.append(df[col])
@@ -86,23 +214,216 @@ def select_annotation(dfs_submission: list, col: str) -> list:
     return dfs_filtered
 
 
-def assert_equal_length(df_gold: pd.DataFrame, df_subs: list, submissions: list):
+def align_tokens(gold_tokens: list, sub_tokens: list) -> np.ndarray:
     """
-    Exclude datasets that are longer than gold standard
+    Align the tokens of a document in a system response to its tokens in the gold standard.
+    Returns the position in `sub_tokens` of the token aligned to each gold token, or -1.
+
+    The alignment is a patience diff: the common leading and trailing tokens of a range are
+    aligned directly, then the tokens that occur once on both sides, in the longest run of them
+    that is in the same order on both sides, and the ranges in between are aligned the same way
+    (up to `MAX_ANCHOR_DEPTH` times). The other ranges are aligned by `difflib.SequenceMatcher`
+    if they have at most `MAX_MATCHER_CELLS` pairs of tokens, larger ones are left unaligned.
+    The cost is thus bounded by O(n log n) per level of ranges, plus
+    O(n sqrt(MAX_MATCHER_CELLS)) for the ranges aligned by difflib.
     """
 
-    df_filtered = []
-    try:
-        for i, df in enumerate(df_subs):
-            assert len(df) == len(df_gold)
-            df_filtered.append(df)
-    except AssertionError:
+    aligned = np.full(len(gold_tokens), -1, dtype=np.int64)
+
+    ranges = [(0, len(gold_tokens), 0, len(sub_tokens), 0)]
+    while ranges:
+        gold_start, gold_end, sub_start, sub_end, depth = ranges.pop()
+
+        while (
+            gold_start < gold_end
+            and sub_start < sub_end
+            and gold_tokens[gold_start] == sub_tokens[sub_start]
+        ):
+            aligned[gold_start] = sub_start
+            gold_start += 1
+            sub_start += 1
+        while (
+            gold_start < gold_end
+            and sub_start < sub_end
+            and gold_tokens[gold_end - 1] == sub_tokens[sub_end - 1]
+        ):
+            gold_end -= 1
+            sub_end -= 1
+            aligned[gold_end] = sub_end
+        if gold_start == gold_end or sub_start == sub_end:
+            continue
+
+        anchors = []
+        if depth < MAX_ANCHOR_DEPTH:
+            anchors = unique_anchors(
+                gold_tokens[gold_start:gold_end], sub_tokens[sub_start:sub_end]
+            )
+        if anchors:
+            prev_gold, prev_sub = gold_start, sub_start
+            for i, j in anchors:
+                aligned[gold_start + i] = sub_start + j
+                ranges.append((prev_gold, gold_start + i, prev_sub, sub_start + j, depth + 1))
+                prev_gold, prev_sub = gold_start + i + 1, sub_start + j + 1
+            ranges.append((prev_gold, gold_end, prev_sub, sub_end, depth + 1))
+
+        elif (gold_end - gold_start) * (sub_end - sub_start) <= MAX_MATCHER_CELLS:
+            matcher = SequenceMatcher(
+                None,
+                gold_tokens[gold_start:gold_end],
+                sub_tokens[sub_start:sub_end],
+                autojunk=False,
+            )
+            for i, j, size in matcher.get_matching_blocks():
+                aligned[gold_start + i : gold_start + i + size] = np.arange(
+                    sub_start + j, sub_start + j + size
+                )
+
+    return aligned
+
+
+def unique_anchors(gold_tokens: list, sub_tokens: list) -> list:
+    """
+    Pairs of positions (gold, response) of the tokens that occur exactly once in both lists,
+    keeping the longest run of them that is in the same order in both lists.
+    """
+
+    gold_counts, sub_counts = {}, {}
+    for token in gold_tokens:
+        gold_counts[token] = gold_counts.get(token, 0) + 1
+    for token in sub_tokens:
+        sub_counts[token] = sub_counts.get(token, 0) + 1
+    sub_positions = {
+        token: j for j, token in enumerate(sub_tokens) if sub_counts[token] == 1
+    }
+    pairs = [
+        (i, sub_positions[token])
+        for i, token in enumerate(gold_tokens)
+        if gold_counts[token] == 1 and token in sub_positions
+    ]
+
+    # longest increasing subsequence of the response positions, by patience sorting
+    tails, tail_pairs, previous = [], [], []
+    for k, (_, j) in enumerate(pairs):
+        pile = bisect_left(tails, j)
+        if pile == len(tails):
+            tails.append(j)
+            tail_pairs.append(k)
+        else:
+            tails[pile] = j
+            tail_pairs[pile] = k
+        previous.append(tail_pairs[pile - 1] if pile > 0 else -1)
+
+    anchors = []
+    k = tail_pairs[-1] if tail_pairs else -1
+    while k >= 0:
+        anchors.append(pairs[k])
+        k = previous[k]
+
+    return anchors[::-1]
+
+
+def align_submissions(
+    df_gold: pd.DataFrame, dfs_submission: list, submissions: list, jobs: int = 1
+) -> list:
+    """
+    Align the system responses that do not have as many tokens as the gold standard.
+
+    The tokens of a response are matched to the gold tokens by document ID and surface
+    with `align_tokens`, one document at a time and in parallel when `jobs` is greater than 1.
+    Aligned responses have one row per gold token, with missing labels for the gold tokens
+    without a counterpart. Responses without any aligned token are excluded.
+    """
+
+    gold_docs = df_gold.groupby("DOCUMENT_ID", sort=False).indices
+    gold_tokens = df_gold.TOKEN.astype(str).to_numpy(dtype=object)
+
+    # one task per document of each response to align: (response, gold rows, response rows)
+    tasks = []
+    for k, df in enumerate(dfs_submission):
+        if len(df) == len(df_gold):
+            continue
+        sub_docs = df.groupby("DOCUMENT_ID", sort=False, observed=True).indices
+        if not set(sub_docs).intersection(gold_docs):
+            # documents cannot be matched by ID, align the whole response at once
+            tasks.append((k, np.arange(len(df_gold)), np.arange(len(df))))
+            continue
+        tasks += [
+            (k, gold_rows, sub_docs[doc_id])
+            for doc_id, gold_rows in gold_docs.items()
+            if doc_id in sub_docs
+        ]
+
+    sub_tokens = {
+        k: dfs_submission[k].TOKEN.astype(str).to_numpy(dtype=object) for k, _, _ in tasks
+    }
+    gold_args = [gold_tokens[gold_rows].tolist() for _, gold_rows, _ in tasks]
+    sub_args = [sub_tokens[k][sub_rows].tolist() for k, _, sub_rows in tasks]
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            alignments = list(executor.map(align_tokens, gold_args, sub_args, chunksize=16))
+    else:
+        alignments = [align_tokens(gold, sub) for gold, sub in zip(gold_args, sub_args)]
+
+    # position in the response of the token aligned to each gold token, or -1
+    sub_index = {k: np.full(len(df_gold), -1, dtype=np.int64) for k in sub_tokens}
+    for (k, gold_rows, sub_rows), aligned in zip(tasks, alignments):
+        sub_index[k][gold_rows[aligned >= 0]] = sub_rows[aligned[aligned >= 0]]
+
+    dfs_aligned = []
+    for k, df in enumerate(dfs_submission):
+        if k not in sub_index:
+            dfs_aligned.append(df)
+            continue
+
+        n_aligned = (sub_index[k] >= 0).sum()
         logging.info(
-            f"Excluded dataset that do not match length of the gold standard: {submissions[i]}"
+            f"Aligned {n_aligned}/{len(df_gold)} tokens of the gold standard "
+            + f"with {n_aligned}/{len(df)} tokens of {submissions[k]}"
         )
-        pass
+        if n_aligned == 0:
+            logging.info(
+                f"Excluded dataset that could not be aligned to the gold standard: {submissions[k]}"
+            )
+            continue
+        # unaligned gold tokens get missing labels (index -1 is not in the response)
+        dfs_aligned.append(df.reindex(sub_index[k]).reset_index(drop=True))
+
+    return dfs_aligned
 
-    return df_filtered
+
+def encode_votes(df_gold: pd.DataFrame, df_aggr: pd.DataFrame, col: str) -> tuple:
+    """
+    Encode the gold labels and the system labels (tokens x systems) of a column as integer codes.
+    Missing labels are encoded as -1.
+    """
+
+    votes = df_aggr.to_numpy(dtype=object)
+    codes, labels = pd.factorize(
+        np.concatenate([df_gold[col].to_numpy(dtype=object), votes.ravel()])
+    )
+    gold_codes = codes[: len(df_gold)]
+    vote_codes = codes[len(df_gold) :].reshape(votes.shape)
+
+    return gold_codes, vote_codes, labels
+
+
+def top_labels(vote_codes: np.ndarray, labels: pd.Index, n: int = 3) -> list:
+    """
+    Format the n most frequent labels of a row of votes with their relative frequency,
+    ordered as by `value_counts(normalize=True)` (ties by first occurrence).
+    """
+
+    valid = vote_codes[vote_codes >= 0]
+    if len(valid) == 0:
+        return []
+
+    counts = np.bincount(valid)
+    row_labels, first = np.unique(valid, return_index=True)
+    order = np.lexsort((first, -counts[row_labels]))[:n]
+
+    return [
+        f"{labels[row_labels[k]]}: {counts[row_labels[k]] / len(valid):.2f}" for k in order
+    ]
 
 
 def aggregate_responses(
@@ -111,14 +432,20 @@ def aggregate_responses(
     """
     Log all gold standard annotations (any column for NERC, NEL)
     for which system predictions are below a particular threshold.
+
+    For each column, the frequency of the gold label among the system labels
+    is computed for all tokens at once, and only the tokens below the threshold
+    are looked at one by one.
     """
 
-    columns = [item for item in df_gold.columns if item not in {"index", "TOKEN", "MISC"}]
+    columns = [item for item in df_gold.columns if item not in META_COLUMNS]
 
     dfs_submission = [df for df in dfs_submission if len(df) == len(df_gold)]
 
     for col in columns:
         dfs_filtered = select_annotation(dfs_submission, col)
+        if not dfs_filtered:
+            continue
         df_aggr = pd.concat(dfs_filtered, axis=1)
 
         # add column with entity surface
@@ -129,34 +456,43 @@ def aggregate_responses(
             df_gold[col].isin(["O", "-", "_"]), df_gold.TOKEN, df_gold.SURFACE
         )
 
+        # rows of df_aggr are matched to the gold standard by position
+        rows = df_aggr.index.to_numpy()
+        gold_codes, vote_codes, labels = encode_votes(df_gold.iloc[rows], df_aggr, col)
+
+        # share of the (non-missing) system labels that are the gold label
+        n_votes = (vote_codes >= 0).sum(axis=1)
+        is_gold = (vote_codes == gold_codes[:, None]) & (gold_codes[:, None] >= 0)
+        n_gold_votes = is_gold.sum(axis=1)
+        gold_share = n_gold_votes / np.maximum(n_votes, 1)
+        # tokens without any vote (e.g. not aligned in any response) cannot be judged
+        flagged = np.flatnonzero((n_votes > 0) & ((n_gold_votes == 0) | (gold_share < threshold)))
+
+        golds = df_gold[col].to_numpy(dtype=object)
+        surfaces = df_gold["SURFACE"].to_numpy(dtype=object)
+
         anno_gold_prev = None
-        for i, row in df_aggr.iterrows():
-            token = df_gold.iloc[i]["TOKEN"]
-            surface = df_gold.iloc[i]["SURFACE"]
-            anno_gold = df_gold.iloc[i][col]
-            anno_count = OrderedDict(row.value_counts(normalize=True).to_dict())
-            anno_count_common = [
-                f"{label}: {frq:.2f}" for label, frq in list(anno_count.items())[:3]
-            ]
+        for k in flagged:
+            i = rows[k]
+            surface = surfaces[i]
+            anno_gold = golds[i]
 
             if log_once_per_label and anno_gold == anno_gold_prev:
                 continue
 
-            try:
-                if anno_count[anno_gold] < threshold:
-                    msg = (
-                        "Systems predicted primarily other than the true label. "
-                        + f"SURFACE: `{surface}`, TRUE: {anno_gold} \t PRED: {anno_count_common} \t LINE: {i}, COL: {col}"
-                    )
-                    logging.warning(msg)
-                    anno_gold_prev = anno_gold
-            except KeyError:
+            anno_count_common = top_labels(vote_codes[k], labels)
+            if n_gold_votes[k] > 0:
+                msg = (
+                    "Systems predicted primarily other than the true label. "
+                    + f"SURFACE: `{surface}`, TRUE: {anno_gold} \t PRED: {anno_count_common} \t LINE: {i}, COL: {col}"
+                )
+            else:
                 msg = (
                     "No system predicted the true label. "
                     + f"SURFACE: `{surface}`, TRUE: {anno_gold} \t PRED: {anno_count_common} \t LINE: {i}, COL: {col}"
                 )
-                logging.warning(msg)
-                anno_gold_prev = anno_gold
+            logging.warning(msg)
+            anno_gold_prev = anno_gold
 
 
 def main(args):
@@ -165,6 +501,8 @@ def main(args):
     f_gold = args["--gold_file"]
     threshold = float(args["--threshold"])
     log_file = args["--log_file"]
+    jobs = int(args["--jobs"])
+    cache_dir = args["--cache_dir"]
 
     logging.basicConfig(
         filename=log_file,
@@ -183,8 +521,10 @@ def main(args):
     submissions = index_files(input_dir, lang=lang)
     logging.info(f"Total number of system responses: {len(submissions)}")
 
-    dfs_submission = [read_dataframe(fname) for fname in submissions]
-    dfs_submission = assert_equal_length(df_gold, dfs_submission, submissions)
+    # only the annotation columns of the gold standard are compared
+    columns = [col for col in df_gold.columns if col not in META_COLUMNS]
+    dfs_submission = load_submissions(submissions, columns, jobs=jobs, cache_dir=cache_dir)
+    dfs_submission = align_submissions(df_gold, dfs_submission, submissions, jobs=jobs)
 
     aggregate_responses(df_gold, dfs_submission, threshold=threshold)
 
@@ -19,13 +19,18 @@ Options:
 """
 
 from collections import defaultdict
+import csv
+import heapq
 import json
 import logging
+import os
 from pathlib import Path
+from typing import Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
-from fuzzywuzzy import process
 from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils
 from docopt import docopt
 
 
@@ -68,83 +73,207 @@ def get_unique_items(df, surface_form):
     return df_cluster
 
 
+def iter_groups(df, groupby):
+    """
+    Iterate over the groups of a dataframe, yielding the positions of their rows sorted by count
+    """
+
+    # sorting the counts alone orders ties as sorting the rows of the group would
+    counts = pd.Series(df["count"].to_numpy(), index=np.arange(len(df)))
+    for index, group_counts in counts.groupby(df[groupby].to_numpy()):
+        yield index, group_counts.sort_values(ascending=False).index.to_numpy()
+
+
 def group2json(df, groupby, fname, only_ambigious=False):
     """
-    Write group object into a nested json file
+    Write group object into a nested json file, one group at a time
     """
 
-    grouped = df.groupby(groupby)
     coarse_col = "wikidata_id" if groupby == "cluster" else "cluster"
 
-    results = {}
+    with open(fname, "w", encoding='utf-8') as f:
+        f.write("{")
+        n_groups = 0
+
+        records = df.to_dict("records")
 
-    for index, nested_rows in grouped:
+        # groups come sorted by key, as `json.dumps(results, sort_keys=True)` writes them
+        for index, positions in iter_groups(df, groupby):
 
-        fine = defaultdict(list)
+            fine = defaultdict(list)
 
-        for _, row in nested_rows.sort_values("count", ascending=False).iterrows():
-            fine[row[coarse_col]].append(row.to_dict())
+            for i in positions:
+                fine[records[i][coarse_col]].append(records[i])
 
             # coarse collects a single attribute only (i.e., link, surface cluster)
             # fine collects all the information for each entity-link combinations
             # subgrouped by the coarse_col
             if only_ambigious and len(fine) < 2:
                 continue
-            else:
-                results[index] = {"coarse": list(fine.keys()), "fine": fine}
 
-    with open(fname, "w", encoding='utf-8') as f:
-        f.write(json.dumps(results, sort_keys=True, ensure_ascii=False))
+            # a single-item dict, for the key to be written as json.dumps writes keys
+            item = json.dumps(
+                {index: {"coarse": list(fine.keys()), "fine": fine}},
+                sort_keys=True,
+                ensure_ascii=False,
+            )
+            if n_groups > 0:
+                f.write(", ")
+            f.write(item[1:-1])
+            n_groups += 1
+
+        f.write("}")
 
 
 def group2csv(df, groupby, fname, only_ambigious=False):
     """
-    Write flattened group object in csv
+    Write flattened group object in csv, one group at a time
     """
 
-    grouped = df.groupby(groupby)
+    value_col = "wikidata_id" if groupby == "cluster" else "surface_lower"
+    header = [groupby, "QID", "count"] if groupby == "cluster" else [groupby, "surface", "count"]
 
-    results = []
+    with open(fname, "w", encoding='utf-8', newline="") as f:
+        writer = csv.writer(f, lineterminator=os.linesep)
+        writer.writerow(header)
 
-    for index, nested_rows in grouped:
-        r = []
+        values = df[value_col].tolist()
+        counts = df["count"].tolist()
+        for index, positions in iter_groups(df, groupby):
+            writer.writerows([index, values[i], counts[i]] for i in positions)
 
-        for _, row in nested_rows.sort_values("count", ascending=False).iterrows():
-            if groupby == "cluster":
-                r = [index, row["wikidata_id"], row["count"]]
-            else:
-                r = [index, row["surface_lower"], row["count"]]
-            results.append(r)
 
-        flat_df = pd.DataFrame(results)
-        header = [groupby, "QID", "count"] if groupby == "cluster" else [groupby, "surface", "count"]
-        flat_df.to_csv(fname, index=False, header=header, encoding='utf-8')
+class FuzzyIndex:
+    """Finds the best `fuzz.ratio` matches of strings among fixed choices.
 
+    Matches are the same as with `process.extractBests(query, choices,
+    scorer=fuzz.ratio, score_cutoff=score_cutoff)`, i.e. strings are compared after
+    `utils.full_process`, but only the choices that may reach the cutoff are scored.
+    As `fuzz.ratio` is 2 * M / T, where M is the number of matching characters and
+    T the total length of both strings, M is bounded in bulk for all choices by the
+    lengths (blocking on length) and then by the characters the strings have in
+    common. Choices are scored once per distinct processed string, and the scores
+    of each processed query are cached.
+    """
 
-def fuzzy_mapping(df, col="surface_lower", score_cutoff=80):
-    mappings = {}
+    def __init__(self, choices: List[str], score_cutoff: int):
+        self.choices = choices
+        self.score_cutoff = score_cutoff
+
+        processed = [utils.full_process(choice) for choice in choices]
+        self.keys = list(dict.fromkeys(processed))
+        self.key_index = {key: i for i, key in enumerate(self.keys)}
+        self.choice_keys = np.array([self.key_index[key] for key in processed], dtype=np.int64)
+
+        # distinct processed choices sorted by length, with their character counts
+        self.order = np.argsort([len(key) for key in self.keys], kind="stable")
+        self.lengths = np.array([len(self.keys[i]) for i in self.order], dtype=np.int64)
+        self.char_index = {char: i for i, char in enumerate(sorted({c for k in self.keys for c in k}))}
+        self.char_counts = np.zeros((len(self.keys), len(self.char_index)), dtype=np.int32)
+        for row, i in enumerate(self.order):
+            for char in self.keys[i]:
+                self.char_counts[row, self.char_index[char]] += 1
+
+        self._cache = {}
+
+    def candidates(self, processed_query: str) -> np.ndarray:
+        """Returns the distinct processed choices that may reach the cutoff with a query.
+
+        :param str processed_query: The query, processed with `utils.full_process`.
+        :return: Indices into `keys`.
+        :rtype: np.ndarray
+
+        """
+        # scores are rounded, so a ratio of (cutoff - 0.5) may still reach the cutoff
+        min_ratio = self.score_cutoff - 0.5
+        if min_ratio <= 0:
+            return np.arange(len(self.keys))
+
+        # the number of matching characters is at most the length of the shortest string
+        query_length = len(processed_query)
+        min_length = min_ratio * query_length / (200 - min_ratio)
+        max_length = query_length * (200 - min_ratio) / min_ratio
+        first = np.searchsorted(self.lengths, min_length - 1e-9, side="left")
+        last = np.searchsorted(self.lengths, max_length + 1e-9, side="right")
+
+        # ... and at most the number of characters both strings have in common
+        query_counts = defaultdict(int)
+        for char in processed_query:
+            query_counts[char] += 1
+        common = np.zeros(last - first, dtype=np.int64)
+        for char, count in query_counts.items():
+            if char in self.char_index:
+                common += np.minimum(self.char_counts[first:last, self.char_index[char]], count)
+
+        totals = np.maximum(self.lengths[first:last] + query_length, 1)
+        rows = first + np.flatnonzero(200 * common / totals >= min_ratio - 1e-9)
+        candidates = self.order[rows]
+
+        # equal strings score 100, empty ones included
+        if processed_query in self.key_index:
+            candidates = np.union1d(candidates, [self.key_index[processed_query]])
+        return candidates
+
+    def scores(self, query: str) -> Dict[int, int]:
+        """Scores a query against the distinct processed choices that may reach the cutoff.
+
+        :param str query: The query.
+        :return: The scores of at least the cutoff, by index into `keys`.
+        :rtype: Dict[int, int]
+
+        """
+        processed_query = utils.full_process(query)
+        if processed_query not in self._cache:
+            scores = {}
+            for i in self.candidates(processed_query).tolist():
+                score = fuzz.ratio(processed_query, self.keys[i])
+                if score >= self.score_cutoff:
+                    scores[i] = score
+            self._cache[processed_query] = scores
+        return self._cache[processed_query]
+
+    def extract_bests(self, query: str, limit: int = 5) -> List[Tuple[str, int]]:
+        """Returns the best matches of a query, as `process.extractBests`.
+
+        :param str query: The query.
+        :param int limit: Maximum number of matches.
+        :return: The matching choices and their scores, best first.
+        :rtype: List[Tuple[str, int]]
+
+        """
+        scores = self.scores(query)
+        positions = np.flatnonzero(np.isin(self.choice_keys, list(scores)))
+        matches = [(self.choices[i], scores[self.choice_keys[i]]) for i in positions.tolist()]
+        return heapq.nlargest(limit, matches, key=lambda match: match[1])
 
-    for _, cand in df.iterrows():
 
-        cand_text = cand[col]
+def fuzzy_mapping(df, col="surface_lower", score_cutoff=80):
+    """Maps each surface form to the most frequent of its (up to 5) best fuzzy matches.
 
-        # avoid redundant computations
-        if cand_text in mappings:
-            continue
+    :param pd.DataFrame df: Unique surface-link items with their `count`, see `get_unique_items`.
+    :param str col: Column of the surface forms.
+    :param int score_cutoff: Minimum `fuzz.ratio` of a match.
+    :return: The surface form of the cluster of each surface form.
+    :rtype: dict
 
-        matches = process.extractBests(
-            cand[col], df[col].unique(), score_cutoff=score_cutoff, scorer=fuzz.ratio
-        )
+    """
+    surfaces = df[col].unique().tolist()
+    index = FuzzyIndex(surfaces, score_cutoff)
+    max_counts = df.groupby(col)["count"].max().to_dict()
+
+    mappings = {}
+    for surface in surfaces:
+        matches = index.extract_bests(surface)
 
         # point to most frequent match
         main_count = 0
         for match, score in matches:
-            count = int(df[df[col] == match].sort_values("count", ascending=False).iloc[0]["count"])
+            count = int(max_counts[match])
             if count > main_count:
                 main_match = match
                 main_count = count
 
-        mappings[cand_text] = main_match
+        mappings[surface] = main_match
 
     return mappings
 
@@ -14,8 +14,9 @@ from tqdm import tqdm
 from typing import NamedTuple
 
 from helpers import ImpressoDocument, compute_levenshtein_distance
+from helpers.xmi import get_typesystem
 
-from cassis import Cas, load_cas_from_xmi, load_typesystem
+from cassis import Cas, load_cas_from_xmi
 
 
 sys.path.append("../../impresso_evaluation")
@@ -125,8 +126,7 @@ def read_xmi(xmi_file: str, xml_file: str, sanity_check: bool = True) -> Impress
     relations = []
     mentions = OrderedDict()
 
-    with open(xml_file, "rb") as f:
-        typesystem = load_typesystem(f)
+    typesystem = get_typesystem(xml_file)
 
     with open(xmi_file, "rb") as f:
         cas = load_cas_from_xmi(f, typesystem=typesystem)
@@ -13,7 +13,7 @@ import os
 import random
 from typing import List
 from helpers import read_annotation_assignments
-from helpers.tsv import is_tsv_complete, write_tsv, parse_tsv
+from helpers.tsv import is_tsv_complete, write_tsv, iter_tsv
 
 LOGGER = logging.getLogger(__name__)
 
@@ -130,7 +130,7 @@ def create_datasets(input_dir, output_dir, version):
 
             if split == "test":
                 # generate a version of the test dataset with ground truth values masked out
-                tsv_data = parse_tsv(dataset_path, mask_nerc=True, mask_nel=True)
+                tsv_data = iter_tsv(dataset_path, mask_nerc=True, mask_nel=True)
                 masked_dataset_name = os.path.basename(dataset_path).replace(
                     "-test-", "-test-masked-"
                 )
@@ -140,7 +140,7 @@ def create_datasets(input_dir, output_dir, version):
                 write_tsv(tsv_data, masked_dataset_path)
 
                 # now do the same for bundle 5 masking
-                tsv_data = parse_tsv(dataset_path, mask_nel=True, mask_nerc=False)
+                tsv_data = iter_tsv(dataset_path, mask_nel=True, mask_nerc=False)
                 masked_dataset_name = os.path.basename(dataset_path).replace(
                     "-test-", "-test-masked-bundle5-"
                 )
@@ -2,6 +2,7 @@ import os
 import logging
 import glob
 import re
+import shutil
 import pandas as pd
 from typing import NamedTuple
 
@@ -69,4 +70,8 @@ def compute_levenshtein_distance(surface: str, transcript: str) -> int:
 def clean_directory(path: str):
     files = glob.glob(f"{os.path.join(path, '*')}")
     for f in files:
-        os.remove(f)
+        # e.g. dataframes partitioned into folders
+        if os.path.isdir(f):
+            shutil.rmtree(f)
+        else:
+            os.remove(f)
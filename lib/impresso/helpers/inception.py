@@ -8,12 +8,13 @@ from collections import OrderedDict
 from pathlib import Path
 from typing import Generator, List, Tuple
 
-from cassis import Cas, load_cas_from_xmi, load_typesystem
+from cassis import Cas, load_cas_from_xmi
 from pycaprio import Pycaprio
 from pycaprio.core.objects.project import Project
 from pycaprio.mappings import InceptionFormat
 
 from . import ImpressoDocument
+from .xmi import get_typesystem
 
 LOGGER = logging.getLogger(__name__)
 
@@ -109,8 +110,7 @@ def read_xmi_for_stats(xmi_file: str, xml_file: str) -> ImpressoDocument:
     mentions = OrderedDict()
     iiifs = []
 
-    with open(xml_file, "rb") as f:
-        typesystem = load_typesystem(f)
+    typesystem = get_typesystem(xml_file)
 
     with open(xmi_file, "rb") as f:
         cas = load_cas_from_xmi(f, typesystem=typesystem)
@@ -1,15 +1,34 @@
 from tqdm import tqdm
 import os
+import hashlib
 import logging
+import logging.handlers
+import multiprocessing
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
 import pandas as pd
-from typing import Tuple
+from typing import Dict, List, NamedTuple, Optional, Tuple
 from .inception import read_xmi_for_stats
 from . import read_annotation_assignments
 
 LOGGER = logging.getLogger(__name__)
 
+# files of the code extracting records from a document, see `records_cache_key`
+EXTRACTION_CODE_FILES = [__file__, read_xmi_for_stats.__code__.co_filename]
+
+
+class DocumentRecords(NamedTuple):
+    n_tokens: int
+    n_mentions: int
+    n_entities: int
+    mentions: List[Dict]
+    entities: List[Dict]
+
 
 def is_nested(row: pd.Series, mentions_df: pd.DataFrame) -> bool:
+    """Checks whether a mention is contained in another mention, see `find_nested_mentions`."""
     start = row.start_offset
     end = row.end_offset
 
@@ -31,6 +50,77 @@ def is_nested(row: pd.Series, mentions_df: pd.DataFrame) -> bool:
     return containing_mentions.shape[0] > 0
 
 
+def find_nested_mentions(mentions_df: pd.DataFrame) -> pd.Series:
+    """Finds the mentions contained in another mention of the same document.
+
+    Gives the same result as applying `is_nested` to each row, i.e. a mention that
+    is not `comp` is nested if another `comp`-free mention with a different surface
+    starts before (or at) its start and ends after (or at) its end. Instead of
+    filtering all mentions for each mention, the mentions are sorted by document
+    and start offset, then swept once, keeping the furthest end offset seen so far
+    along with the furthest end offset of a mention with another surface.
+
+    :param pd.DataFrame mentions_df: Mentions, with `doc_id`, `start_offset`,
+        `end_offset`, `surface` and `entity_coarse` columns.
+    :return: Whether each mention is nested, with the index of `mentions_df`.
+    :rtype: pd.Series
+
+    """
+    # mentions without a document are never nested, as no `doc_id` equals them
+    is_candidate = (mentions_df.entity_coarse != "comp") & mentions_df.doc_id.notna()
+    positions = np.flatnonzero(is_candidate.to_numpy())
+
+    # sort by document, then by start offset
+    doc_codes = pd.factorize(mentions_df.doc_id.to_numpy()[positions])[0]
+    starts = mentions_df.start_offset.to_numpy()[positions]
+    positions = positions[np.lexsort((starts, doc_codes))]
+
+    doc_ids = mentions_df.doc_id.to_numpy()[positions].tolist()
+    starts = mentions_df.start_offset.to_numpy()[positions].tolist()
+    ends = mentions_df.end_offset.to_numpy()[positions].tolist()
+    # missing surfaces differ from any surface, their own included, as in
+    # `is_nested` where such a mention is its own containing mention
+    is_missing = mentions_df.surface.isna().to_numpy()[positions].tolist()
+    surfaces = [
+        object() if missing else surface
+        for surface, missing in zip(mentions_df.surface.to_numpy()[positions].tolist(), is_missing)
+    ]
+
+    nested = np.zeros(len(mentions_df), dtype=bool)
+    is_nested_mention = []
+    i = 0
+    while i < len(positions):
+        if i == 0 or doc_ids[i] != doc_ids[i - 1]:
+            # furthest end so far and its surface, and furthest end with another surface
+            best_end, best_surface, other_end = float("-inf"), None, float("-inf")
+
+        # mentions starting at the same offset contain each other's start
+        j = i
+        while j < len(positions) and starts[j] == starts[i] and doc_ids[j] == doc_ids[i]:
+            end, surface = ends[j], surfaces[j]
+            if surface == best_surface:
+                best_end = max(best_end, end)
+            elif end > best_end:
+                best_end, best_surface, other_end = end, surface, best_end
+            elif end > other_end:
+                other_end = end
+            j += 1
+
+        for k in range(i, j):
+            container_end = other_end if surfaces[k] == best_surface else best_end
+            is_nested_mention.append(is_missing[k] or container_end >= ends[k])
+        i = j
+
+    nested[positions] = is_nested_mention
+    nested = pd.Series(nested, index=mentions_df.index)
+
+    if LOGGER.isEnabledFor(logging.INFO):
+        for row in mentions_df[nested].itertuples():
+            LOGGER.info(f"Found nested entity {row.surface} {row.start_offset} {row.end_offset} {row.doc_id}")
+
+    return nested
+
+
 def read_split_assignments(input_dir: str) -> pd.DataFrame:
     languages = ["de", "en", "fr"]
     dfs = []
@@ -47,67 +137,174 @@ def read_split_assignments(input_dir: str) -> pd.DataFrame:
     return assignments_df[["Split"]]
 
 
+def extract_document_records(
+    xmi_path: str, xml_path: str, name: str, language: str, cache_dir: Optional[str] = None
+) -> DocumentRecords:
+    """Extracts the mention and entity records of an annotated document.
+
+    :param str xmi_path: Path to the XMI file of the document.
+    :param str xml_path: Path to the schema of the XMI file.
+    :param str name: Name of the document, used as `doc_id` of its records.
+    :param str language: Language of the document.
+    :param str cache_dir: Folder of the record cache. If given, the records of a
+        document whose XMI file and schema are unchanged are loaded from there.
+    :return: The counts and records of the document.
+    :rtype: DocumentRecords
+
+    """
+    if cache_dir:
+        cache_path = os.path.join(
+            cache_dir, f"{records_cache_key(xmi_path, xml_path, name, language)}.pickle"
+        )
+        if os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                return pickle.load(f)
+
+    doc = read_xmi_for_stats(xmi_path, xml_path)
+
+    mentions = [
+        {
+            "doc_id": name,
+            "annotation_id": mention["id"],
+            "entity_fine": mention["entity_fine"],
+            "entity_coarse": mention["entity_coarse"],
+            "surface": mention["surface"],
+            "is_literal": True if mention["literal"] else False,
+            "language": language,
+            "noisy_ocr": mention["noisy_ocr"],
+            "transcript": mention["transcript"],
+            "start_offset": mention["start_offset"],
+            "end_offset": mention["end_offset"],
+        }
+        for mention in doc.mentions.values()
+    ]
+    entities = [
+        {
+            "doc_id": name,
+            "surface": entity["surface"],
+            "entity_id": entity["entity_id"],
+            "is_NIL": entity["is_NIL"],
+            "wikidata_id": entity["wikidata_id"],
+            "language": language,
+            "unsolvable_linking": entity["unsolvable_linking"],
+        }
+        for entity in doc.links.values()
+    ]
+    records = DocumentRecords(
+        len(doc.text.split()), len(doc.mentions), len(doc.links), mentions, entities
+    )
+
+    if cache_dir:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+
+    return records
+
+
+def records_cache_key(xmi_path: str, xml_path: str, name: str, language: str) -> str:
+    """Computes the key of a document in the record cache of `extract_document_records`.
+
+    The key changes whenever the XMI file, the schema or the code of the extraction
+    (this module and `read_xmi_for_stats`) change.
+
+    :return: The cache key.
+    :rtype: str
+    """
+    digest = hashlib.sha1()
+    for path in [xmi_path, xml_path, *EXTRACTION_CODE_FILES]:
+        with open(path, "rb") as f:
+            digest.update(hashlib.sha1(f.read()).digest())
+    digest.update(f"{name}\t{language}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def init_worker(log_queue: multiprocessing.Queue):
+    """Send the log records of a worker process to the main process through `log_queue`."""
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root_logger.setLevel(logging.INFO)
+
+
 def create_entity_dataframes(
-    document_metadata_df: pd.DataFrame, nerc_only: bool = False
+    document_metadata_df: pd.DataFrame,
+    nerc_only: bool = False,
+    jobs: int = 1,
+    cache_dir: Optional[str] = None,
 ):
+    """Creates the dataframes of the mentions and entities of the annotated documents.
+
+    Documents are read by `extract_document_records`, in parallel when `jobs` is
+    greater than 1, and the dataframes are built at once from their records.
 
-    mentions = []
-    entities = []
+    :param pd.DataFrame document_metadata_df: Documents, see `create_metadata_dataframes`.
+        Their `n_tokens`, `n_mentions` and `n_entities` columns are filled in.
+    :param bool nerc_only: Do not create the dataframe of the entities.
+    :param int jobs: Number of worker processes reading documents.
+    :param str cache_dir: Folder of the record cache, see `extract_document_records`.
+    :return: The document metadata and mentions dataframes, and the entities
+        dataframe unless `nerc_only`.
 
-    for doc_id, doc_metadata in tqdm(
-        list(document_metadata_df.iterrows()),
-        desc="Creating dataframes from annotated data (XMI)",
-    ):
+    """
+    doc_ids = document_metadata_df.index.tolist()
+    xmi_paths = [
+        os.path.join(base_dir, name.replace(".txt", ".xmi"))
+        for base_dir, name in zip(document_metadata_df["base_dir"], document_metadata_df["name"])
+    ]
+    xml_paths = [
+        os.path.join(base_dir, "TypeSystem.xml") for base_dir in document_metadata_df["base_dir"]
+    ]
+    names = document_metadata_df["name"].tolist()
+    languages = document_metadata_df["language"].tolist()
+    desc = "Creating dataframes from annotated data (XMI)"
 
-        # perhaps parallelize it with dask?
-        doc_xmi_path = os.path.join(
-            doc_metadata["base_dir"], doc_metadata["name"].replace(".txt", ".xmi")
+    if jobs > 1:
+        # workers log through a queue, which is emptied into
+        # the handlers (i.e. the log file) of the main process
+        log_queue = multiprocessing.Queue()
+        log_listener = logging.handlers.QueueListener(
+            log_queue, *logging.getLogger().handlers, respect_handler_level=True
         )
-        doc_xml_path = os.path.join(doc_metadata["base_dir"], "TypeSystem.xml")
-        doc = read_xmi_for_stats(doc_xmi_path, doc_xml_path)
-
-        document_metadata_df.loc[doc_id, "n_tokens"] = len(doc.text.split())
-        document_metadata_df.loc[doc_id, "n_mentions"] = len(doc.mentions)
-        document_metadata_df.loc[doc_id, "n_entities"] = len(doc.links)
-
-        for mention in list(doc.mentions.values()):
-            mentions.append(
-                {
-                    "doc_id": doc_metadata["name"],
-                    "annotation_id": mention["id"],
-                    "entity_fine": mention["entity_fine"],
-                    "entity_coarse": mention["entity_coarse"],
-                    "surface": mention["surface"],
-                    "is_literal": True if mention["literal"] else False,
-                    "language": doc_metadata["language"],
-                    "noisy_ocr": mention["noisy_ocr"],
-                    "transcript": mention["transcript"],
-                    "start_offset": mention["start_offset"],
-                    "end_offset": mention["end_offset"],
-                }
-            )
-        if not nerc_only:
-            for entity in list(doc.links.values()):
-                entities.append(
-                    {
-                        "doc_id": doc_metadata["name"],
-                        "surface": entity["surface"],
-                        "entity_id": entity["entity_id"],
-                        "is_NIL": entity["is_NIL"],
-                        "wikidata_id": entity["wikidata_id"],
-                        "language": doc_metadata["language"],
-                        "unsolvable_linking": entity["unsolvable_linking"],
-                    }
+        log_listener.start()
+
+        try:
+            with ProcessPoolExecutor(
+                max_workers=jobs, initializer=init_worker, initargs=(log_queue,)
+            ) as executor:
+                # results come back in document order, whichever worker finishes first
+                results = executor.map(
+                    extract_document_records,
+                    xmi_paths,
+                    xml_paths,
+                    names,
+                    languages,
+                    [cache_dir] * len(doc_ids),
                 )
-    mentions_df = pd.DataFrame(mentions)
-    mentions_df["is_nested"] = mentions_df.apply(
-        lambda row: is_nested(row, mentions_df), axis=1
-    )
-    entities_df = pd.DataFrame(entities)
+                records = list(tqdm(results, total=len(doc_ids), desc=desc))
+        finally:
+            log_listener.stop()
+
+    else:
+        records = [
+            extract_document_records(xmi_path, xml_path, name, language, cache_dir)
+            for xmi_path, xml_path, name, language in tqdm(
+                list(zip(xmi_paths, xml_paths, names, languages)), desc=desc
+            )
+        ]
+
+    for column in ["n_tokens", "n_mentions", "n_entities"]:
+        document_metadata_df.loc[doc_ids, column] = [getattr(r, column) for r in records]
+
+    mentions_df = pd.DataFrame([mention for r in records for mention in r.mentions])
+    mentions_df["is_nested"] = find_nested_mentions(mentions_df)
 
     if nerc_only:
         return (document_metadata_df, mentions_df)
     else:
+        entities_df = pd.DataFrame([entity for r in records for entity in r.entities])
         return (document_metadata_df, mentions_df, entities_df)
 
 
@@ -1,6 +1,13 @@
 import os
 import io
-from typing import Set, List, Union, NamedTuple
+import csv
+import mmap
+from array import array
+from typing import Dict, Iterable, Iterator, Optional, Set, List, Tuple, Union, NamedTuple
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 COL_LABELS = [
     "TOKEN",
@@ -50,6 +57,42 @@ class TSVAnnotation(NamedTuple):
 TSVLine = Union[TSVAnnotation, TSVComment]
 
 
+class TSVIndexEntry(NamedTuple):
+    document_id: str
+    offset: int
+    length: int
+    n_tokens: int
+    commentary: str
+    page: str
+    language: str
+
+
+# suffix of the index sidecar of a TSV file, see `write_tsv_index`
+INDEX_SUFFIX = ".idx"
+
+# bits of `ColumnarTSV.misc_flags`, by MISC flag
+MISC_FLAGS = {
+    "NoSpaceAfter": 1,
+    "EndOfLine": 2,
+    "EndOfSentence": 4,
+    "InPrimaryReference": 8,
+    "InSecondaryReference": 16,
+    "Partial": 32,
+    "LED": 64,
+}
+
+
+class TSVFormatError(ValueError):
+    """A malformed line in a TSV file, raised by `iter_tsv` in strict mode."""
+
+    def __init__(self, file_path: str, line_number: int, line: str, reason: str):
+        self.file_path = file_path
+        self.line_number = line_number
+        self.line = line
+        self.reason = reason
+        super().__init__(f"{file_path}, line {line_number}: {reason}: {line!r}")
+
+
 def find_datasets_files(base_dir: str) -> List[str]:
     """Finds recursively TSV file in a folder.
 
@@ -133,15 +176,9 @@ def parse_comment(comment_line: str, line_number: int) -> TSVComment:
     :rtype: TSVComment
 
     """
-    try:
-        key, value = [
-            value.strip() for value in comment_line.replace("#", "").split("=")
-        ]
-    except:
-        import ipdb
-
-        ipdb.set_trace()
-    return TSVComment(n=line_number, field=key, value=value)
+    # values may contain "=" themselves, e.g. in URLs
+    key, _, value = comment_line.replace("#", "").partition("=")
+    return TSVComment(n=line_number, field=key.strip(), value=value.strip())
 
 
 def parse_annotation(line: str, line_number: int) -> TSVAnnotation:
@@ -165,17 +202,82 @@ def parse_annotation(line: str, line_number: int) -> TSVAnnotation:
 def parse_tsv(
     file_path: str, mask_nerc: bool = False, mask_nel: bool = False
 ) -> List[List[TSVLine]]:
+    return list(iter_tsv(file_path, mask_nerc, mask_nel))
+
+
+def iter_tsv(
+    file_path: str, mask_nerc: bool = False, mask_nel: bool = False, strict: bool = False
+) -> Iterator[List[TSVLine]]:
+    """Parses a TSV file in HIPE format one document at a time.
 
+    Documents are separated by an empty line and the lines are numbered within
+    their document, as with `parse_tsv`, but the file is read line by line.
+
+    :param str file_path: Path to the TSV file.
+    :param bool mask_nerc: Mask the NERC and NEL annotations, see `mask_all_groundtruth`.
+    :param bool mask_nel: Mask the NEL annotations, see `mask_nel_groundtruth`.
+    :param bool strict: Raise a `TSVFormatError` for annotation lines without all
+        the columns in `COL_LABELS` and comment lines without a field name.
+    :return: The lines of each document, without the header and empty lines.
+    :rtype: Iterator[List[TSVLine]]
+
+    """
     with open(file_path) as f:
-        documents = [
-            [
-                parse_tsv_line(line, line_number, mask_nerc, mask_nel)
-                for line_number, line in enumerate(document.split("\n"))
-                if not line.startswith("TOKEN") and line != ""
-            ]
-            for document in f.read().split("\n\n")
-        ]
-    return documents
+        document = []
+        # number of lines of the document so far, empty and header lines included
+        n_lines = 0
+
+        for file_line_number, line in enumerate(f, start=1):
+            is_terminated = line.endswith("\n")
+            if is_terminated:
+                line = line[:-1]
+
+            # an empty line ends the document, unless it is its first line
+            if line == "" and is_terminated and n_lines > 0:
+                yield document
+                document = []
+                n_lines = 0
+                continue
+
+            if not line.startswith("TOKEN") and line != "":
+                if strict:
+                    check_tsv_line(line, file_path, file_line_number)
+                document.append(parse_tsv_line(line, n_lines, mask_nerc, mask_nel))
+            n_lines += 1
+
+        yield document
+
+
+def iter_tsv_lines(
+    file_path: str, mask_nerc: bool = False, mask_nel: bool = False, strict: bool = False
+) -> Iterator[Tuple[int, TSVLine]]:
+    """Parses a TSV file in HIPE format one line at a time, see `iter_tsv`.
+
+    :return: The index of the document of each line (from 0) and the line.
+    :rtype: Iterator[Tuple[int, TSVLine]]
+
+    """
+    for document_index, document in enumerate(
+        iter_tsv(file_path, mask_nerc, mask_nel, strict)
+    ):
+        for line in document:
+            yield document_index, line
+
+
+def check_tsv_line(line: str, file_path: str, file_line_number: int) -> None:
+    """Raises a `TSVFormatError` if a (non-empty, non-header) line is malformed."""
+    if is_comment(line):
+        if not line.replace("#", "").partition("=")[0].strip():
+            raise TSVFormatError(file_path, file_line_number, line, "comment without field name")
+    else:
+        n_columns = len(line.split("\t"))
+        if n_columns != len(COL_LABELS):
+            raise TSVFormatError(
+                file_path,
+                file_line_number,
+                line,
+                f"expected {len(COL_LABELS)} columns, found {n_columns}",
+            )
 
 
 def parse_tsv_line(
@@ -239,13 +341,454 @@ def mask_nel_groundtruth(annotation: TSVAnnotation, mask: str = "_") -> TSVAnnot
     return masked_annotation
 
 
-def write_tsv(documents: List[List[TSVLine]], output_path: str) -> None:
-    headers = COL_LABELS
-    raw_csv = "\n\n".join(
-        ["\n".join([str(line) for line in document]) for document in documents]
-    )
-    headers_line = "\t".join(headers)
-    csv_content = f"{headers_line}\n{raw_csv}"
+def write_tsv(documents: Iterable[List[TSVLine]], output_path: str) -> None:
+    """Writes documents in a TSV file in HIPE format, one document at a time.
+
+    :param documents: The lines of each document, e.g. as read by `iter_tsv`.
+    :param str output_path: Path to the TSV file.
+    :return: None
+    :rtype: None
+
+    """
+    headers_line = "\t".join(COL_LABELS)
 
     with io.open(output_path, "w", encoding="utf-8") as f:
-        f.write(csv_content)
+        f.write(f"{headers_line}\n")
+        for i, document in enumerate(documents):
+            if i > 0:
+                f.write("\n\n")
+            f.write("\n".join([str(line) for line in document]))
+
+
+def write_tsv_index(entries: Iterable[TSVIndexEntry], index_path: str) -> None:
+    """Writes the index sidecar of a TSV file, one tab-separated line per document.
+
+    :param entries: The byte range and metadata of each document of the TSV file.
+    :param str index_path: Path to the index, i.e. the TSV file path plus `INDEX_SUFFIX`.
+    :return: None
+    :rtype: None
+
+    """
+    with io.open(index_path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f, delimiter="\t", lineterminator="\n")
+        writer.writerow(TSVIndexEntry._fields)
+        writer.writerows(entries)
+
+
+def read_tsv_index(index_path: str) -> Dict[str, TSVIndexEntry]:
+    """Reads the index sidecar of a TSV file, see `write_tsv_index`.
+
+    :param str index_path: Path to the index.
+    :return: The index entries by document ID, in file order.
+    :rtype: Dict[str, TSVIndexEntry]
+
+    """
+    with io.open(index_path, encoding="utf-8", newline="") as f:
+        reader = csv.reader(f, delimiter="\t")
+        next(reader)
+        index = {}
+        for document_id, offset, length, n_tokens, commentary, page, language in reader:
+            # a document repeated in the TSV file is read from its first occurrence
+            index.setdefault(
+                document_id,
+                TSVIndexEntry(
+                    document_id, int(offset), int(length), int(n_tokens), commentary, page, language
+                ),
+            )
+    return index
+
+
+class TSVReader:
+    """Random access to the documents of a TSV file in HIPE format.
+
+    Documents are located with the index sidecar of the file (see `write_tsv_index`)
+    and read from a memory map of the file, so that getting one document does not
+    parse the documents before it.
+
+    Usage:
+        with TSVReader("ajmc-v0.4-dev-de.tsv") as reader:
+            document = reader.get("Wecklein1894_0006")
+    """
+
+    def __init__(self, file_path: str, index_path: Optional[str] = None):
+        """
+        :param str file_path: Path to the TSV file.
+        :param str index_path: Path to its index, the file path plus `INDEX_SUFFIX` by default.
+        """
+        self.file_path = file_path
+        self.index = read_tsv_index(index_path or file_path + INDEX_SUFFIX)
+        self._file = open(file_path, "rb")
+        # empty files cannot be memory-mapped
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b""
+
+        # in `parse_tsv`, the header line is the first line of the first document
+        self._header_end = 0
+        if self._mmap[:5] == b"TOKEN":
+            self._header_end = self._mmap.find(b"\n") + 1
+
+    def __enter__(self) -> "TSVReader":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, document_id: str) -> bool:
+        return document_id in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def get_text(self, document_id: str) -> str:
+        """Returns the lines of a document as they are in the file.
+
+        :param str document_id: ID of the document.
+        :return: The text of the document.
+        :rtype: str
+        :raises KeyError: If the document is not in the index.
+
+        """
+        entry = self.index[document_id]
+        return self._mmap[entry.offset:entry.offset + entry.length].decode("utf-8")
+
+    def get(
+        self, document_id: str, mask_nerc: bool = False, mask_nel: bool = False
+    ) -> List[TSVLine]:
+        """Parses a document, with the same line numbers as `parse_tsv`.
+
+        :param str document_id: ID of the document.
+        :param bool mask_nerc: Mask the NERC and NEL annotations, see `mask_all_groundtruth`.
+        :param bool mask_nel: Mask the NEL annotations, see `mask_nel_groundtruth`.
+        :return: The lines of the document, without empty lines.
+        :rtype: List[TSVLine]
+        :raises KeyError: If the document is not in the index.
+
+        """
+        first_line_number = 0
+        if self._header_end and self.index[document_id].offset == self._header_end:
+            first_line_number = 1
+
+        return [
+            parse_tsv_line(line, line_number, mask_nerc, mask_nel)
+            for line_number, line in enumerate(
+                self.get_text(document_id).split("\n"), start=first_line_number
+            )
+            if line != ""
+        ]
+
+
+class ColumnarTSV:
+    """Columnar representation of the annotation lines of a TSV file in HIPE format.
+
+    Each column of `COL_LABELS` is kept as an int32 array of codes into the list of
+    its distinct values, so that counting labels or selecting lines is done with
+    NumPy over all lines at once rather than with one `TSVAnnotation` per line.
+
+    :ivar dict codes: code of the value of each line, by column.
+    :ivar dict vocabularies: distinct values of each column, in order of appearance.
+    :ivar np.ndarray document_offsets: index of the first line of each document,
+        followed by the number of lines.
+    :ivar list document_ids: ID of each document, from its `document_id` comment (or None).
+    :ivar list document_comments: metadata comments of each document, value by field.
+    :ivar np.ndarray misc_flags: bitset of the `MISC_FLAGS` of each line.
+    :ivar np.ndarray led: Levenshtein distance of the `LED` flag of each line, NaN if absent.
+    """
+
+    def __init__(
+        self,
+        codes: Dict[str, np.ndarray],
+        vocabularies: Dict[str, List[str]],
+        document_offsets: np.ndarray,
+        document_ids: List[Optional[str]],
+        document_comments: Optional[List[Dict[str, str]]] = None,
+    ):
+        self.codes = codes
+        self.vocabularies = vocabularies
+        self.document_offsets = document_offsets
+        self.document_ids = document_ids
+        self.document_comments = document_comments or [{} for _ in document_ids]
+
+        # flags are parsed once per distinct MISC value
+        parsed_misc = [parse_misc(misc) for misc in vocabularies["MISC"]]
+        misc_flags = np.array([flags for flags, _ in parsed_misc], dtype=np.uint8)
+        led = np.array([led for _, led in parsed_misc], dtype=np.float32)
+        self.misc_flags = misc_flags[codes["MISC"]]
+        self.led = led[codes["MISC"]]
+
+    @classmethod
+    def from_tsv(cls, file_path: str, strict: bool = False) -> "ColumnarTSV":
+        """Loads a TSV file, reading it one document at a time with `iter_tsv`.
+
+        :param str file_path: Path to the TSV file.
+        :param bool strict: Raise a `TSVFormatError` for malformed lines.
+        :return: The columnar representation of the file.
+        :rtype: ColumnarTSV
+
+        """
+        codes = {column: array("i") for column in COL_LABELS}
+        indices = {column: {} for column in COL_LABELS}
+        document_offsets = array("q", [0])
+        document_ids = []
+        document_comments = []
+        n_lines = 0
+
+        for document in iter_tsv(file_path, strict=strict):
+            document_id = None
+            comments = {}
+            for line in document:
+                if isinstance(line, TSVComment):
+                    if document_id is None and line.field.endswith("document_id"):
+                        document_id = line.value
+                    comments.setdefault(line.field, line.value)
+                    continue
+
+                # the fields of an annotation after `n` are in the order of `COL_LABELS`
+                for column, value in zip(COL_LABELS, line[1:]):
+                    index = indices[column]
+                    code = index.get(value)
+                    if code is None:
+                        code = index[value] = len(index)
+                    codes[column].append(code)
+                n_lines += 1
+
+            document_offsets.append(n_lines)
+            document_ids.append(document_id)
+            document_comments.append(comments)
+
+        return cls(
+            {column: np.frombuffer(codes[column], dtype=np.int32) for column in COL_LABELS},
+            {column: list(indices[column]) for column in COL_LABELS},
+            np.frombuffer(document_offsets, dtype=np.int64),
+            document_ids,
+            document_comments,
+        )
+
+    def __len__(self) -> int:
+        return len(self.codes["TOKEN"])
+
+    @property
+    def n_documents(self) -> int:
+        return len(self.document_ids)
+
+    def values(self, column: str) -> np.ndarray:
+        """Returns the values of a column, one per line.
+
+        :param str column: Name of the column, see `COL_LABELS`.
+        :return: An object array of the values.
+        :rtype: np.ndarray
+
+        """
+        return np.array(self.vocabularies[column], dtype=object)[self.codes[column]]
+
+    def code(self, column: str, value: str) -> int:
+        """Returns the code of a value of a column, -1 if it does not occur."""
+        try:
+            return self.vocabularies[column].index(value)
+        except ValueError:
+            return -1
+
+    def label_counts(self, column: str) -> Dict[str, int]:
+        """Counts the lines with each value of a column.
+
+        :param str column: Name of the column, see `COL_LABELS`.
+        :return: The number of lines, by value, in order of first appearance.
+        :rtype: Dict[str, int]
+
+        """
+        counts = np.bincount(self.codes[column], minlength=len(self.vocabularies[column]))
+        return dict(zip(self.vocabularies[column], counts.tolist()))
+
+    def has_flag(self, flag: str) -> np.ndarray:
+        """Returns whether each line has a MISC flag, see `MISC_FLAGS`."""
+        return (self.misc_flags & MISC_FLAGS[flag]) != 0
+
+    def document_index(self) -> np.ndarray:
+        """Returns the index of the document of each line."""
+        return np.repeat(
+            np.arange(self.n_documents), np.diff(self.document_offsets)
+        )
+
+    def select_documents(self, document_ids: Iterable[str]) -> "ColumnarTSV":
+        """Selects the lines of some documents.
+
+        :param document_ids: IDs of the documents to keep.
+        :return: The lines of the documents, in their order in this file.
+        :rtype: ColumnarTSV
+
+        """
+        wanted = set(document_ids)
+        selected = np.array(
+            [i for i, document_id in enumerate(self.document_ids) if document_id in wanted],
+            dtype=np.int64,
+        )
+        keep = np.isin(self.document_index(), selected)
+        lengths = np.diff(self.document_offsets)[selected]
+
+        selection = ColumnarTSV.__new__(ColumnarTSV)
+        selection.codes = {column: codes[keep] for column, codes in self.codes.items()}
+        selection.vocabularies = self.vocabularies
+        selection.document_offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        selection.document_ids = [self.document_ids[i] for i in selected]
+        selection.document_comments = [self.document_comments[i] for i in selected]
+        selection.misc_flags = self.misc_flags[keep]
+        selection.led = self.led[keep]
+        return selection
+
+    def mentions(self, column: str = "NE-COARSE-LIT", link_column: str = "NEL-LIT") -> pd.DataFrame:
+        """Decodes the IOB labels of a column into entity mentions.
+
+        A mention starts at a `B-` label, or at an `I-` label that does not continue
+        a mention of the same type on the previous line of the document, and spans
+        the following `I-` lines of its type. Labels are decoded once per distinct
+        value, then mention boundaries are found with NumPy over all lines at once.
+
+        :param str column: IOB column, e.g. NE-FINE-LIT, NE-NESTED or NE-COARSE-LIT
+            of a biblio file.
+        :param str link_column: Column of the link of a mention, read on its first line.
+        :return: One row per mention, with the ID of its document, its token range
+            in the document (`start` to `end`, exclusive), its label without IOB
+            prefix, its surface (tokens joined according to NoSpaceAfter) and its link.
+        :rtype: pd.DataFrame
+
+        """
+        # (IOB prefix, label) of each value, missing values (short lines) are outside mentions
+        iob = [
+            (value[:2], value[2:]) if isinstance(value, str) else ("", "")
+            for value in self.vocabularies[column]
+        ]
+        prefixes = np.array([prefix for prefix, _ in iob], dtype=object)
+        labels = list(dict.fromkeys(label for prefix, label in iob if prefix in ("B-", "I-")))
+        label_codes = {label: code for code, label in enumerate(labels)}
+        type_codes = np.array(
+            [label_codes[label] if prefix in ("B-", "I-") else -1 for prefix, label in iob],
+            dtype=np.int32,
+        )
+
+        codes = self.codes[column]
+        types = type_codes[codes]
+        is_inside = types >= 0
+        is_begin = (prefixes == "B-")[codes]
+
+        # a line continues the mention of the previous line if it is an I- label of the
+        # same type and both lines are in the same document
+        continues = np.zeros(len(self), dtype=bool)
+        continues[1:] = is_inside[1:] & ~is_begin[1:] & (types[1:] == types[:-1])
+        continues[self.document_offsets[:-1][self.document_offsets[:-1] < len(self)]] = False
+
+        starts = np.flatnonzero(is_inside & ~continues)
+        boundaries = np.flatnonzero(~continues)
+        ends = np.append(boundaries, len(self))[np.searchsorted(boundaries, starts, side="right")]
+
+        document_index = np.searchsorted(self.document_offsets, starts, side="right") - 1
+        document_starts = self.document_offsets[document_index]
+
+        tokens = self.values("TOKEN")
+        separators = np.where(self.has_flag("NoSpaceAfter"), "", " ").astype(object)
+        pieces = tokens + separators
+        surfaces = [
+            "".join(pieces[start:end - 1]) + tokens[end - 1] for start, end in zip(starts, ends)
+        ]
+
+        return pd.DataFrame(
+            {
+                "document_id": [self.document_ids[i] for i in document_index],
+                "start": starts - document_starts,
+                "end": ends - document_starts,
+                "label": np.array(labels, dtype=object)[types[starts]],
+                "surface": surfaces,
+                "link": self.values(link_column)[starts],
+            }
+        )
+
+    def to_arrow(self) -> pa.Table:
+        """Converts the lines to an Arrow table, one row per annotation line.
+
+        The `COL_LABELS` columns are dictionary-encoded with their codes and
+        vocabularies (without copying the codes), followed by one boolean column
+        per `MISC_FLAGS` flag, the `LED` distance (null if absent) and, for each
+        metadata comment field (e.g. `hipe2022:language`), its dictionary-encoded
+        value in the document of the line.
+
+        :return: The table, with a `document_id` column first.
+        :rtype: pa.Table
+
+        """
+        document_index = self.document_index()
+        columns = {"document_id": _document_column(self.document_ids, document_index)}
+
+        for column in COL_LABELS:
+            columns[column] = pa.DictionaryArray.from_arrays(
+                pa.array(self.codes[column]), pa.array(self.vocabularies[column], type=pa.string())
+            )
+
+        for flag in MISC_FLAGS:
+            if flag != "LED":
+                columns[flag] = pa.array(self.has_flag(flag))
+        columns["LED"] = pa.array(self.led, mask=np.isnan(self.led))
+
+        fields = list(dict.fromkeys(field for comments in self.document_comments for field in comments))
+        for field in fields:
+            columns[field] = _document_column(
+                [comments.get(field) for comments in self.document_comments], document_index
+            )
+
+        return pa.table(columns)
+
+    def to_parquet(self, output_path: str) -> None:
+        """Writes the lines to a Parquet file, see `to_arrow`.
+
+        The file can be loaded with `pd.read_parquet`, into categorical columns.
+
+        :param str output_path: Path to the Parquet file.
+        :return: None
+        :rtype: None
+
+        """
+        pq.write_table(self.to_arrow(), output_path)
+
+
+def _document_column(values: List[Optional[str]], document_index: np.ndarray) -> pa.DictionaryArray:
+    """Dictionary-encodes a value of each document over the lines of the documents."""
+    vocabulary = {}
+    codes = np.array(
+        [-1 if value is None else vocabulary.setdefault(value, len(vocabulary)) for value in values],
+        dtype=np.int32,
+    )
+    indices = codes[document_index]
+    return pa.DictionaryArray.from_arrays(
+        pa.array(indices, mask=indices < 0), pa.array(list(vocabulary), type=pa.string())
+    )
+
+
+def parse_misc(misc: Optional[str]) -> Tuple[int, float]:
+    """Parses the MISC column of a line.
+
+    :param str misc: Value of the MISC column, flags separated by "|".
+    :return: The bitset of the `MISC_FLAGS` and the Levenshtein distance (NaN if absent).
+    :rtype: Tuple[int, float]
+
+    """
+    flags = 0
+    led = float("nan")
+    for flag in (misc or "").split("|"):
+        if flag in MISC_FLAGS:
+            flags |= MISC_FLAGS[flag]
+        elif flag.startswith("Partial"):
+            flags |= MISC_FLAGS["Partial"]
+        elif flag.startswith("LED"):
+            try:
+                led = float(flag[3:])
+                flags |= MISC_FLAGS["LED"]
+            except ValueError:
+                pass
+    return flags, led
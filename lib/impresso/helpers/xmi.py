@@ -1,9 +1,46 @@
 import os
 import sys
+import io
+import hashlib
 import pandas as pd
 from tqdm import tqdm
-from typing import List
-from cassis import Cas, load_cas_from_xmi, load_typesystem
+from typing import Dict, List, Tuple
+from cassis import Cas, TypeSystem, load_cas_from_xmi, load_typesystem
+
+# process-wide registry of parsed type systems, keyed by content hash
+_TYPESYSTEMS: Dict[str, TypeSystem] = {}
+
+# (path, mtime) of each schema file seen so far, mapped to its content hash
+_TYPESYSTEM_FINGERPRINTS: Dict[Tuple[str, int], str] = {}
+
+
+def get_typesystem(xml_file: str) -> TypeSystem:
+    """Returns the UIMA type system for a schema file, parsing it only once per process.
+
+    A schema is looked up by its path and modification time first, and then by
+    the hash of its content, so that an edited file is parsed again while
+    identical copies of the same schema (e.g. one per language folder) share a
+    single `TypeSystem` instance.
+
+    :param str xml_file: path to xml schema file.
+    :return: The parsed type system.
+    :rtype: TypeSystem
+
+    """
+    path = os.path.realpath(xml_file)
+    fingerprint = (path, os.stat(path).st_mtime_ns)
+
+    content_hash = _TYPESYSTEM_FINGERPRINTS.get(fingerprint)
+    if content_hash is None:
+        with open(path, "rb") as f:
+            content = f.read()
+        content_hash = hashlib.sha1(content).hexdigest()
+        _TYPESYSTEM_FINGERPRINTS[fingerprint] = content_hash
+
+        if content_hash not in _TYPESYSTEMS:
+            _TYPESYSTEMS[content_hash] = load_typesystem(io.BytesIO(content))
+
+    return _TYPESYSTEMS[content_hash]
 
 
 def find_xmi_files(base_dir: str) -> List[str]:
@@ -38,8 +75,7 @@ def copy_iiif_links(source_xmi: str, target_xmi: str, xmi_schema: str) -> None:
 
     imgLinkType = "webanno.custom.ImpressoImages"
 
-    with open(xmi_schema, "rb") as f:
-        typesystem = load_typesystem(f)
+    typesystem = get_typesystem(xmi_schema)
 
     with open(source_xmi, "rb") as f:
         source_cas = load_cas_from_xmi(f, typesystem=typesystem)
@@ -67,8 +103,7 @@ def contains_iiif_links(xmi_file: str, xmi_schema: str) -> bool:
     """
     imgLinkType = "webanno.custom.ImpressoImages"
 
-    with open(xmi_schema, "rb") as f:
-        typesystem = load_typesystem(f)
+    typesystem = get_typesystem(xmi_schema)
 
     with open(xmi_file, "rb") as f:
         cas = load_cas_from_xmi(f, typesystem=typesystem)
@@ -12,12 +12,13 @@ from pathlib import Path
 import csv
 from collections import OrderedDict
 import pandas as pd
-from cassis import load_cas_from_xmi, load_typesystem
+from cassis import load_cas_from_xmi
 
 from unicodedata import category
 
 sys.path.append("../")
 sys.path.append("../../")
+from helpers.xmi import get_typesystem
 
 
 def parse_args():
@@ -90,8 +91,7 @@ class Retokenizer:
         and remove tokens with unprintable characters.
         """
 
-        with open(self.xml, "rb") as f:
-            self.typesystem = load_typesystem(f)
+        self.typesystem = get_typesystem(self.xml)
 
         with open(self.xmi, "rb") as f:
             self.cas = load_cas_from_xmi(f, typesystem=self.typesystem)
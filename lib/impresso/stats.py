@@ -2,7 +2,12 @@
 Script to produce statistics about annotated data for HIPE shared task.
 
 Usage:
-    lib/stats.py --input-dir=<id> --output-dir=<od> --log-file=<log> [--refresh]
+    lib/stats.py --input-dir=<id> --output-dir=<od> --log-file=<log> [--refresh] [--jobs=<j>] [--cache-dir=<cd>]
+
+Options:
+    --jobs=<j>          Number of worker processes reading the annotated documents [default: 1].
+    --cache-dir=<cd>    Folder of the per-document record cache, so that --refresh only reads
+                        the documents that changed (default: <od>/cache).
 """  # noqa
 
 import glob
@@ -11,8 +16,9 @@ import logging
 import os
 import os.path
 import pathlib
+import shutil
 from pathlib import Path
-from typing import List
+from typing import List, Optional, Tuple
 from textwrap import dedent
 
 import ipdb  # TODO: remove from production
@@ -31,17 +37,59 @@ from helpers.stats import (
 from helpers import clean_directory
 
 
-def save_dataframe(df: pd.DataFrame, filename: str, output_dir: str) -> None:
+# columns by which the serialized dataframes are partitioned
+PARTITION_COLUMNS = ["language", "Split"]
+
+
+def save_dataframe(
+    df: pd.DataFrame, filename: str, output_dir: str, partition_cols: Optional[List[str]] = None
+) -> None:
+    """Saves a dataframe in Parquet format, as a folder with one file per partition.
+
+    :param pd.DataFrame df: The dataframe.
+    :param str filename: Name of the dataframe, see `load_dataframe`.
+    :param str output_dir: Folder of the serialized dataframes.
+    :param list partition_cols: Columns to partition the dataframe by, if any.
+    :return: None
+    :rtype: None
+
+    """
+    file_path = os.path.join(output_dir, f"{filename}.parquet")
+
+    # partitions are added to an existing folder rather than replacing it
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    df.to_parquet(file_path, partition_cols=partition_cols)
+
 
-    df.to_pickle(os.path.join(output_dir, f"{filename}.pkl"))
-    df.to_csv(os.path.join(output_dir, f"{filename}.csv"))
+def load_dataframe(
+    filename: str,
+    input_dir: str,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Tuple]] = None,
+) -> pd.DataFrame:
+    """Loads a dataframe saved with `save_dataframe`.
 
+    Only the given columns are read, from the partitions that match `filters`,
+    e.g. `[("language", "=", "fr")]`. Rows come back grouped by partition.
 
-def load_dataframe(filename: str, input_dir: str) -> pd.DataFrame:
+    :param str filename: Name of the dataframe.
+    :param str input_dir: Folder of the serialized dataframes.
+    :param list columns: Columns to read, all by default.
+    :param list filters: Filters on the partition columns, all partitions by default.
+    :return: The dataframe.
+    :rtype: pd.DataFrame
+
+    """
+    file_path = os.path.join(input_dir, f"{filename}.parquet")
+    df = pd.read_parquet(file_path, columns=columns, filters=filters)
+
+    # partition columns are read as categories
+    for column in df.select_dtypes("category").columns:
+        df[column] = df[column].astype(object)
 
-    file_path = os.path.join(input_dir, f"{filename}.pkl")
     logging.info(f"Loaded dataframe from {file_path}")
-    return pd.read_pickle(file_path)
+    return df
 
 
 def compile_stats_report(filename: str, annotation_type: str, plots_dir: str, output_dir: str):
@@ -366,7 +414,9 @@ def produce_overview_stats(
     fig.savefig(os.path.join(plots_dir, plot_name), dpi=300)
 
 
-def produce_stats(input_dir: str, output_dir: str, refresh: bool):
+def produce_stats(
+    input_dir: str, output_dir: str, refresh: bool, jobs: int = 1, cache_dir: str = None
+):
 
     stats_dir = output_dir
     plots_dir = os.path.join(stats_dir, "plots")
@@ -403,15 +453,27 @@ def produce_stats(input_dir: str, output_dir: str, refresh: bool):
 
         # create some dataframes with mentions and entities information
         (full_document_metadata_df, full_mentions_df, full_entities_df,) = create_entity_dataframes(
-            full_document_metadata_df
+            full_document_metadata_df,
+            jobs=jobs,
+            cache_dir=cache_dir or os.path.join(stats_dir, "cache"),
         )
         # nerc_document_metadata_df, nerc_mentions_df = create_entity_dataframes(nerc_document_metadata_df, True)
 
+        # mentions and entities are partitioned by the split of their document too
+        splits = full_document_metadata_df.Split
+        full_mentions_df["Split"] = full_mentions_df.doc_id.map(lambda d: d.split(".")[0]).map(splits)
+        full_entities_df["Split"] = full_entities_df.doc_id.map(lambda d: d.split(".")[0]).map(splits)
+
         # NERC + NEL annotations
         save_dataframe(full_corpus_metadata_df, "full_corpus-metadata_df", serialized_data_dir)
-        save_dataframe(full_document_metadata_df, "full_document-metadata_df", serialized_data_dir)
-        save_dataframe(full_mentions_df, "full_mentions_df", serialized_data_dir)
-        save_dataframe(full_entities_df, "full_entities_df", serialized_data_dir)
+        save_dataframe(
+            full_document_metadata_df,
+            "full_document-metadata_df",
+            serialized_data_dir,
+            PARTITION_COLUMNS,
+        )
+        save_dataframe(full_mentions_df, "full_mentions_df", serialized_data_dir, PARTITION_COLUMNS)
+        save_dataframe(full_entities_df, "full_entities_df", serialized_data_dir, PARTITION_COLUMNS)
 
         # NERC only annotations
         # save_dataframe(nerc_corpus_metadata_df, 'nerc_corpus-metadata_df', serialized_data_dir)
@@ -420,9 +482,22 @@ def produce_stats(input_dir: str, output_dir: str, refresh: bool):
     else:
         # NERC + NEL annotations
         full_corpus_metadata_df = load_dataframe("full_corpus-metadata_df", serialized_data_dir)
-        full_document_metadata_df = load_dataframe("full_document-metadata_df", serialized_data_dir)
-        full_mentions_df = load_dataframe("full_mentions_df", serialized_data_dir)
-        full_entities_df = load_dataframe("full_entities_df", serialized_data_dir)
+        # only the columns needed for the reports are read
+        full_document_metadata_df = load_dataframe(
+            "full_document-metadata_df",
+            serialized_data_dir,
+            columns=["year", "language", "n_tokens", "n_mentions"],
+        )
+        full_mentions_df = load_dataframe(
+            "full_mentions_df",
+            serialized_data_dir,
+            columns=["doc_id", "annotation_id", "entity_coarse", "is_literal", "language"],
+        )
+        full_entities_df = load_dataframe(
+            "full_entities_df",
+            serialized_data_dir,
+            columns=["doc_id", "entity_id", "is_NIL"],
+        )
 
         # NERC only annotations
         # nerc_corpus_metadata_df = load_dataframe('nerc_corpus-metadata_df', serialized_data_dir)
@@ -472,6 +547,8 @@ def main(args):
     output_dir = args["--output-dir"]
     log_file = args["--log-file"]
     refresh = args["--refresh"] if args["--refresh"] else False
+    jobs = int(args["--jobs"])
+    cache_dir = args["--cache-dir"]
 
     logging.basicConfig(
         filename=log_file,
@@ -480,7 +557,7 @@ def main(args):
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
 
-    produce_stats(input_dir, output_dir, refresh)
+    produce_stats(input_dir, output_dir, refresh, jobs, cache_dir)
 
 
 if __name__ == "__main__":
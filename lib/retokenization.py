@@ -3,22 +3,69 @@ Retokenize UIMA CAS XMI data and save in the original format.
 """
 
 import ipdb
+import re
 import sys
+import queue
 from tqdm import tqdm
-from typing import List
+from typing import List, Tuple
 import argparse
 import logging
+import logging.handlers
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 import csv
 from collections import OrderedDict
 import pandas as pd
-from cassis import load_cas_from_xmi, load_typesystem
+from cassis import load_cas_from_xmi
 
 from unicodedata import category
 
 sys.path.append("../")
 sys.path.append("../../")
-from ajmc_utils import HYPHENS
+import ajmc_utils
+import impresso.helpers.xmi
+from ajmc_utils import HYPHENS, BuildManifest
+from impresso.helpers.xmi import get_typesystem
+
+# signs split off from tokens, in the order in which they used to be split off one after another
+SPLITTING_SIGNS = [
+    # spaces
+    " ",
+    # apostrophes
+    "'",
+    "’",
+    # parentheses
+    "(",
+    ")",
+    "[",
+    "]",
+    "{",
+    "}",
+    # hyphens
+    "-",
+    "—",
+    # punctuation
+    ".",
+    ",",
+    ":",
+    ";",
+    "=",
+    "͵",
+    "„",
+    "“",
+    "‚",
+    "?",
+    "”"
+]
+
+SIGN_RANKS = {sign: rank for rank, sign in enumerate(SPLITTING_SIGNS)}
+
+SPLITTING_PATTERN = re.compile("([" + "".join(re.escape(sign) for sign in SPLITTING_SIGNS) + "])")
+
+# source files of the code retokenizing a document, a change to any of them
+# invalidates all retokenized files in the build manifest
+CODE_FILES = [__file__, ajmc_utils.__file__, impresso.helpers.xmi.__file__]
+
 
 def parse_args():
     """Parse the arguments given with program call"""
@@ -61,6 +108,25 @@ def parse_args():
         help="name of the output dir where the tsv files are stored",
     )
 
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        action="store",
+        dest="jobs",
+        help="number of worker processes retokenizing files in parallel",
+    )
+
+    parser.add_argument(
+        "-m",
+        "--manifest",
+        action="store",
+        default=None,
+        dest="f_manifest",
+        help="path to a build manifest (JSON); files whose input and schema are unchanged are skipped",
+    )
+
     return parser.parse_args()
 
 
@@ -90,149 +156,37 @@ class Retokenizer:
         and remove tokens with unprintable characters.
         """
 
-        with open(self.xml, "rb") as f:
-            self.typesystem = load_typesystem(f)
+        self.typesystem = get_typesystem(self.xml)
 
         with open(self.xmi, "rb") as f:
             self.cas = load_cas_from_xmi(f, typesystem=self.typesystem)
 
-        self.split_off_spaces()
-        self.split_off_apostrophes()
-        self.split_off_parenthesis()
-        self.split_off_hyphens()
-        self.split_off_punctuation()
+        self.split_off_signs()
         self.remove_unprintable_tokens()
         self.remove_empty_tokens()
 
-    def split_off_spaces(self):
+    def split_off_signs(self):
         """
-        Split off spaces when present in a token
+        Split off spaces, apostrophes, parentheses, hyphens and punctuation
+        when glued together with token, in a single pass over the tokens.
 
         Example:
-        TODO add example
-        """
-
-        cas = self.cas
-        tokenType = self.tokenType
-        splitting_sign = " "
-
-        tokens = []
-        for tok in cas.select(tokenType):
-            tok_text = tok.get_covered_text()
-            if splitting_sign in tok_text and len(tok_text) > 1:
-                tokens += self.splitting_at_symbol(tok, splitting_sign)
-                #ipdb.set_trace()
-        cas.add_all(tokens)
-
-    def split_off_apostrophes(self):
-        """
-        Split off apostrophes when glued together with token
-
-        Example:
-        2020-02-17 10:20:28,567 - root - INFO - Token 'Finanz-Budger's' was tokenized into ['Finanz-Budger', "'", 's']
-        """
-
-        cas = self.cas
-        tokenType = self.tokenType
-
-        tokens = []
-        for tok in cas.select(tokenType):
-            tok_text = tok.get_covered_text()
-            if "'" in tok_text and len(tok_text) > 1:
-                tokens += self.splitting_at_symbol(tok, "'")
-        cas.add_all(tokens)
-
-        tokens = []
-        for tok in cas.select(tokenType):
-            tok_text = tok.get_covered_text()
-            if "’" in tok_text and len(tok_text) > 1:
-                tokens += self.splitting_at_symbol(tok, "’")
-        cas.add_all(tokens)
-
-    def split_off_parenthesis(self):
-        """
-        Split off apostrophes when glued together with token
-        Example:
+        2020-02-17 10:20:28,567 - root - INFO - Token 'Finanz-Budger's' was tokenized into ['Finanz', '-', 'Budger', "'", 's']
         2022-03-15 11:36:27,908 - root - INFO - Token '(Martin' was tokenized into ['(', 'Martin']
-        
-        """
-
-        cas = self.cas
-        tokenType = self.tokenType
-
-        splitting_signs = [
-            "(",
-            ")",
-            "[",
-            "]",
-            "{",
-            "}"
-        ]
-
-        for splitting_sign in splitting_signs:
-            tokens = []
-            for tok in cas.select(tokenType):
-                tok_text = tok.get_covered_text()
-                if splitting_sign in tok_text and len(tok_text) > 1:
-                    tokens += self.splitting_at_symbol(tok, splitting_sign)
-            cas.add_all(tokens)
-
-    def split_off_hyphens(self):
-        """
-        Split off hyphens when glued together with token
-
-        Example:
-        2020-02-17 10:20:28,568 - root - INFO - Token 'Finanz-Budger' was tokenized into ['Finanz', '-', 'Budger']
-        """
-
-        cas = self.cas
-        tokenType = self.tokenType
-
-        splitting_signs = [
-            "-",
-            "—"
-        ]
-        for splitting_sign in splitting_signs:
-            tokens = []
-            for tok in cas.select(tokenType):
-                tok_text = tok.get_covered_text()
-                if splitting_sign in tok_text and len(tok_text) > 1:
-                    tokens += self.splitting_at_symbol(tok, splitting_sign)
-            cas.add_all(tokens)
-
-    def split_off_punctuation(self):
-        """
-        Split off punctuation when glued together with token
-
-        Example:
         2022-03-15 11:26:16,585 - root - INFO - Token 'Chevaliers,' was tokenized into ['Chevaliers', ',']
-        2022-03-15 11:26:16,767 - root - INFO - Token 'σιωπῇ.' was tokenized into ['σιωπῇ', '.']
         """
 
         cas = self.cas
         tokenType = self.tokenType
 
-        splitting_signs = [
-            ".",
-            ",",
-            ":",
-            ";",
-            "=",
-            "͵",
-            "„",
-            "“",
-            "‚",
-            "?",
-            "”"
-        ]
+        tokens = []
+        for tok in cas.select(tokenType):
+            tokens += self.splitting_at_signs(tok)
 
-        for splitting_sign in splitting_signs:
-            tokens = []
-            for tok in cas.select(tokenType):
-                tok_text = tok.get_covered_text()
-                if splitting_sign in tok_text and len(tok_text) > 1:
-                    tokens += self.splitting_at_symbol(tok, splitting_sign)
-            cas.add_all(tokens)
+        # add the new tokens in the order in which splitting at one sign
+        # after the other would create them, so that they get the same XMI ids
+        tokens.sort(key=lambda x: (x[0], x[1].begin, x[1].end))
+        cas.add_all([token for _, token in tokens])
 
     def remove_unprintable_tokens(self):
         """
@@ -293,60 +247,67 @@ class Retokenizer:
         for idx in reversed(remove_tokens):
             del cas._current_view.type_index[tokenType][idx]
 
-    def splitting_at_symbol(self, tok, symbol: str):
-        """Split a token into its subtokens at a particular symbol (e.g., apostroph).
+    def splitting_at_signs(self, tok) -> List[Tuple[int, "Token"]]:
+        """Split a token into its subtokens at every splitting sign (e.g., apostroph).
         A token may yield multiple subtokens.
 
+        The subtokens are the same as if the token was split at each sign in
+        `SPLITTING_SIGNS` in turn: every sign becomes a subtoken of its own and
+        an empty subtoken is kept between two identical adjacent signs
+        (e.g. "--").
+
         :param type tok: Original Token object .
-        :param str symbol: Symbol at which token get splitted into subtokens.
-        :return: Atomic subtokens equivalent to token when concatenated.
-        :rtype: List of Token objects
+        :return: New subtokens (the original token is shortened to the first one),
+            each with the rank of the sign whose split creates it.
+        :rtype: List of (int, Token) tuples
 
         """
 
-        Token = self.typesystem.get_type(self.tokenType)
-
-        tokens = []
         tok_text = tok.get_covered_text()
-        tok_splits = tok_text.split(symbol)
-
-        # insert splitting symbol at every second position
-        i = 1
-        while i < len(tok_splits):
-            tok_splits.insert(i, symbol)
-            i += 2
+        if len(tok_text) <= 1:
+            return []
+
+        parts = SPLITTING_PATTERN.split(tok_text)
+        if len(parts) == 1:
+            return []
+
+        # every odd part is a splitting sign, every even part the text between two signs
+        tok_splits = []
+        offsets = []
+        split_pos = 0
+        for i, part in enumerate(parts):
+            if part:
+                tok_splits.append(part)
+                offsets.append(split_pos)
+            elif 0 < i < len(parts) - 1 and parts[i - 1] == parts[i + 1]:
+                # consider the empty string between two identical signs (e.g. "a..b");
+                # at the beginning or end of a token it is dropped (e.g. Alex', "(um")
+                tok_splits.append(part)
+                offsets.append(split_pos)
+            split_pos += len(part)
+
+        if len(tok_splits) == 1:
+            return []
 
-        # consider the empty string when the splitting symbols
-        # occurs at the end of a token (e.g. Alex')
-        if not tok_splits[-1]:
-            del tok_splits[-1]
-
-        # consider the empty string when the splitting symbols
-        # occurs at the beginning of a token (e.g. "(um")
-        if not tok_splits[0]:
-            del tok_splits[0]
-
-        # redefine the boundary of the first token up to the first split
-        split_pos = len(tok_splits[0])
-        tok.end = tok.begin + split_pos
+        Token = self.typesystem.get_type(self.tokenType)
 
         # add new segments for remaining tokens
         # apostrophes are also tokens
-        for split in tok_splits[1:]:
-            start = tok.begin + split_pos
-            end = tok.begin + split_pos + len(split)
-            tokens.append(Token(begin=start, end=end))
-            split_pos += len(split)
-
-        try:
-            assert tok_text == "".join(tok_splits)
-            logging.info(
-                f"Token '{tok_text}' was tokenized into {tok_splits} in document: {self.xmi}"
-            )
-        except AssertionError:
-            logging.error(
-                f"Token '{tok_text}' couldn't be properly tokenized into {tok_splits} in document: {self.xmi}"
+        tokens = []
+        for split, offset in zip(tok_splits[1:], offsets[1:]):
+            start = tok.begin + offset
+            rank = min(
+                SIGN_RANKS.get(tok_text[offset - 1], len(SPLITTING_SIGNS)),
+                SIGN_RANKS.get(tok_text[offset], len(SPLITTING_SIGNS)),
             )
+            tokens.append((rank, Token(begin=start, end=start + len(split))))
+
+        # redefine the boundary of the first token up to the first split
+        tok.end = tok.begin + len(tok_splits[0])
+
+        logging.info(
+            f"Token '{tok_text}' was tokenized into {tok_splits} in document: {self.xmi}"
+        )
 
         return tokens
 
@@ -364,12 +325,69 @@ def index_inception_files(dir_data, suffix=".xmi") -> list:
     return sorted([path for path in Path(dir_data).rglob("*" + suffix)])
 
 
-def batch_retokenization(dir_in: str, dir_out: str, f_schema: str):
+def retokenize_file(f_xmi_in: Path, f_xmi_out: Path, f_schema: str) -> bool:
+    """Retokenize a single xmi file.
+
+    Errors are logged instead of raised, so that a malformed file does not
+    abort the retokenization of the other files.
+
+    :param Path f_xmi_in: Path to the input .xmi-file.
+    :param Path f_xmi_out: Path to the retokenized output .xmi-file.
+    :param str f_schema: Path to the .XML-file of the schema.
+    :return: Whether the file was retokenized successfully.
+    :rtype: bool
+
+    """
+
+    try:
+        f_xmi_out.parent.mkdir(parents=True, exist_ok=True)
+        retokenizer = Retokenizer(f_xmi_in, f_schema)
+        retokenizer.retokenize()
+        retokenizer.cas.to_xmi(f_xmi_out, pretty_print=True)
+        return True
+    except Exception:
+        logging.exception(f"Retokenization of {f_xmi_in} failed")
+        return False
+
+
+def init_worker():
+    """Buffer the log records of a worker process, see `retokenize_file_in_worker`."""
+
+    root_logger = logging.getLogger()
+    root_logger.handlers = [logging.handlers.QueueHandler(queue.SimpleQueue())]
+    root_logger.setLevel(logging.INFO)
+
+
+def retokenize_file_in_worker(
+    f_xmi_in: Path, f_xmi_out: Path, f_schema: str
+) -> Tuple[bool, List[logging.LogRecord]]:
+    """Retokenize a single xmi file in a worker process.
+
+    :return: Whether the file was retokenized successfully, and the log records emitted meanwhile.
+    :rtype: Tuple[bool, List[logging.LogRecord]]
+
+    """
+
+    success = retokenize_file(f_xmi_in, f_xmi_out, f_schema)
+
+    log_queue = logging.getLogger().handlers[0].queue
+    records = []
+    while not log_queue.empty():
+        records.append(log_queue.get())
+
+    return success, records
+
+
+def batch_retokenization(
+    dir_in: str, dir_out: str, f_schema: str, jobs: int = 1, f_manifest: str = None
+):
     """Start a batch retokenization of xmi files in the given folder .
 
     :param str dir_in: Top-level folder containing the .xmi-files.
     :param str dir_out: Top-level output folder for the converted documents.
     :param str f_schema: Path to the .XML-file of the schema.
+    :param int jobs: Number of worker processes retokenizing files in parallel.
+    :param str f_manifest: Path to the build manifest, to skip files whose inputs are unchanged.
     :return: None.
     :rtype: None
 
@@ -378,15 +396,59 @@ def batch_retokenization(dir_in: str, dir_out: str, f_schema: str):
     xmi_in_files = index_inception_files(dir_in)
     xmi_out_files = [Path(str(p).replace(dir_in, dir_out)) for p in xmi_in_files]
 
+    fingerprints = {}
+    if f_manifest:
+        manifest = BuildManifest(f_manifest, CODE_FILES)
+        for f_xmi_in, f_xmi_out in zip(xmi_in_files, xmi_out_files):
+            fingerprints[f_xmi_out] = manifest.fingerprint([f_xmi_in, f_schema])
+
+        changed_files = [
+            (f_xmi_in, f_xmi_out)
+            for f_xmi_in, f_xmi_out in zip(xmi_in_files, xmi_out_files)
+            if not manifest.is_up_to_date(f_xmi_out, fingerprints[f_xmi_out])
+        ]
+        xmi_in_files = [f_xmi_in for f_xmi_in, _ in changed_files]
+        xmi_out_files = [f_xmi_out for _, f_xmi_out in changed_files]
+        logging.info(f"Skipped {len(fingerprints) - len(changed_files)} unchanged files.")
+
     msg = f"Start retokenization of {len(xmi_in_files)} files."
     logging.info(msg)
     print(msg)
 
-    for f_xmi_in, f_xmi_out in tqdm(list(zip(xmi_in_files, xmi_out_files))):
-        f_xmi_out.parent.mkdir(parents=True, exist_ok=True)
-        retokenizer = Retokenizer(f_xmi_in, f_schema)
-        retokenizer.retokenize()
-        retokenizer.cas.to_xmi(f_xmi_out, pretty_print=True)
+    failed_files = []
+
+    if jobs > 1:
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as executor:
+            results = executor.map(
+                retokenize_file_in_worker,
+                xmi_in_files,
+                xmi_out_files,
+                [f_schema] * len(xmi_in_files),
+            )
+            # results come back in file order, so do the log records
+            for f_xmi_in, (success, records) in tqdm(
+                zip(xmi_in_files, results), total=len(xmi_in_files)
+            ):
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+                if not success:
+                    failed_files.append(f_xmi_in)
+
+    else:
+        for f_xmi_in, f_xmi_out in tqdm(list(zip(xmi_in_files, xmi_out_files))):
+            if not retokenize_file(f_xmi_in, f_xmi_out, f_schema):
+                failed_files.append(f_xmi_in)
+
+    if failed_files:
+        msg = f"Retokenization failed for {len(failed_files)} files: {[str(f) for f in failed_files]}"
+        logging.error(msg)
+        print(msg)
+
+    if f_manifest:
+        for f_xmi_in, f_xmi_out in zip(xmi_in_files, xmi_out_files):
+            if f_xmi_in not in failed_files:
+                manifest.update(f_xmi_out, fingerprints[f_xmi_out])
+        manifest.save()
 
     logging.info(f"Retokenization completed.")
 
@@ -402,7 +464,9 @@ def main():
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
     )
 
-    batch_retokenization(args.dir_in, args.dir_out, args.f_schema)
+    batch_retokenization(
+        args.dir_in, args.dir_out, args.f_schema, jobs=args.jobs, f_manifest=args.f_manifest
+    )
 
 
 ################################################################################
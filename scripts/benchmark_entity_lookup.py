@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmark the per-token entity/hyphenation lookup of the TSV conversion on a synthetic page.
+
+Usage:
+    scripts/benchmark_entity_lookup.py [--n-tokens=<nt> --n-mentions=<nm> --seed=<s>]
+
+Options:
+    --n-tokens=<nt>     Number of tokens of the synthetic page [default: 10000].
+    --n-mentions=<nm>   Number of entity mentions of the synthetic page [default: 2000].
+    --seed=<s>          Random seed [default: 42].
+"""
+
+import sys
+sys.path.append('./lib')
+import random
+import time
+import logging
+from collections import OrderedDict
+from docopt import docopt
+
+from ajmc_utils import AjmcDocument, OffsetIndex
+from convert_xmi2clef_format import convert_data
+
+ENTITY_TYPES = ["pers.author", "work.primlit", "scope", "loc", "primary-full", "secondary-partial"]
+
+
+def make_document(n_tokens: int, n_mentions: int) -> AjmcDocument:
+    """Creates a page of `n_tokens` tokens, with lines of 10 tokens and `n_mentions` (partly nested) mentions."""
+    text = " ".join(f"w{i:05d}" for i in range(n_tokens))
+    tokens = [
+        {"id": i, "start_offset": i * 7, "end_offset": i * 7 + 6, "surface": f"w{i:05d}"}
+        for i in range(n_tokens)
+    ]
+
+    sentences = OrderedDict()
+    for n, i in enumerate(range(0, n_tokens, 10)):
+        sentences[n] = {
+            "segment_id": n,
+            "start_offset": tokens[i]["start_offset"],
+            "end_offset": tokens[min(i + 9, n_tokens - 1)]["end_offset"],
+            "tokens": tokens[i:i + 10],
+            "corrupted": False,
+        }
+
+    mentions = OrderedDict()
+    links = {}
+    for n in range(n_mentions):
+        first = random.randrange(n_tokens)
+        last = min(n_tokens - 1, first + random.randint(0, 5))
+        value = random.choice(ENTITY_TYPES)
+        mentions[n] = {
+            "id": n,
+            "entity_fine": value,
+            "entity_coarse": value.split(".")[0],
+            "entity_biblio": value if "-" in value else None,
+            "start_offset": tokens[first]["start_offset"],
+            "end_offset": tokens[last]["end_offset"],
+            "literal": "true",
+            "levenshtein_norm": 0,
+        }
+        links[n] = {"entity_id": n, "is_NIL": False, "wikidata_id": "Q42"}
+
+    hyphenated_words = [
+        {
+            "id": n,
+            "start_offset": tokens[i]["start_offset"],
+            "end_offset": tokens[i + 1]["end_offset"],
+            "surface": tokens[i]["surface"] + tokens[i + 1]["surface"],
+        }
+        for n, i in enumerate(random.sample(range(n_tokens - 1), n_tokens // 100))
+    ]
+
+    return AjmcDocument(
+        "Wecklein1894_0001",
+        "Wecklein1894_0001.xmi",
+        "data/preparation/corpus/de/retokenized/Wecklein1894_0001.xmi",
+        sentences,
+        mentions,
+        hyphenated_words,
+        links,
+        text,
+    )
+
+
+def scan_lookup(tok: dict, annotations: list) -> list:
+    """The linear scan over all annotations that `OffsetIndex` replaces."""
+    matches = []
+    for ann in annotations:
+        if tok["start_offset"] <= ann["start_offset"] < tok["end_offset"]:
+            matches.append(("B", ann))
+        elif ann["start_offset"] <= tok["start_offset"] < ann["end_offset"]:
+            matches.append(("I", ann))
+    return matches
+
+
+def main(args):
+    random.seed(int(args["--seed"]))
+    logging.disable(logging.CRITICAL)
+
+    doc = make_document(int(args["--n-tokens"]), int(args["--n-mentions"]))
+    tokens = [tok for seg in doc.sentences.values() for tok in seg["tokens"]]
+    mentions = list(doc.mentions.values())
+
+    start = time.perf_counter()
+    scanned = [scan_lookup(tok, mentions) for tok in tokens]
+    scan_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = OffsetIndex(mentions)
+    indexed = [index.lookup(tok["start_offset"], tok["end_offset"]) for tok in tokens]
+    index_time = time.perf_counter() - start
+
+    assert scanned == indexed
+
+    start = time.perf_counter()
+    convert_data(doc, drop_nested=False)
+    convert_time = time.perf_counter() - start
+
+    print(f"{len(tokens)} tokens, {len(mentions)} mentions, {len(doc.hyphenated_words)} hyphenated words")
+    print(f"linear scan lookup:   {scan_time:.3f}s")
+    print(f"OffsetIndex lookup:   {index_time:.3f}s ({scan_time / index_time:.0f}x)")
+    print(f"convert_data (total): {convert_time:.3f}s")
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    main(arguments)
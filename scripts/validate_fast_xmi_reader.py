@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check that reading xmi files with `XmiAnnotations` (lxml) gives the same documents as with cassis.
+
+Usage:
+    scripts/validate_fast_xmi_reader.py --schema=<xml> <xmi_file>...
+
+Options:
+    --schema=<xml>  Path to the .XML-file of the schema.
+"""
+
+import sys
+sys.path.append('./lib')
+import time
+import logging
+from docopt import docopt
+
+from ajmc_utils import read_xmi
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    f_schema = args["--schema"]
+
+    cassis_time = 0
+    fast_time = 0
+    mismatches = []
+    for xmi_file in args["<xmi_file>"]:
+        start = time.perf_counter()
+        expected = read_xmi(xmi_file, f_schema, sanity_check=False)
+        cassis_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        actual = read_xmi(xmi_file, f_schema, sanity_check=False, fast=True)
+        fast_time += time.perf_counter() - start
+
+        if actual != expected:
+            fields = [field for field in expected._fields if getattr(actual, field) != getattr(expected, field)]
+            mismatches.append(xmi_file)
+            print(f"MISMATCH {xmi_file}: {', '.join(fields)}")
+
+    n_files = len(args["<xmi_file>"])
+    print(f"{n_files - len(mismatches)}/{n_files} documents identical")
+    print(f"cassis: {cassis_time:.2f}s, lxml: {fast_time:.2f}s ({cassis_time / fast_time:.1f}x)")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    sys.exit(main(arguments))
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check that splitting off all signs in a single pass (`Retokenizer.split_off_signs`) gives the
+same XMI as the former pipeline, which split tokens at one sign after the other.
+
+Documents are compared on the given xmi files and on random tokens made of the splitting signs.
+
+Usage:
+    scripts/validate_retokenization.py --schema=<xml> [--n-random=<n> --seed=<s>] [<xmi_file>...]
+
+Options:
+    --schema=<xml>      Path to the .XML-file of the schema.
+    --n-random=<n>      Number of random documents [default: 3000].
+    --seed=<s>          Random seed [default: 42].
+"""
+
+import sys
+sys.path.append('./lib')
+import random
+import time
+import logging
+from docopt import docopt
+from cassis import Cas, load_cas_from_xmi
+
+from impresso.helpers.xmi import get_typesystem
+from retokenization import SPLITTING_SIGNS, Retokenizer
+
+
+def splitting_at_symbol(retokenizer: Retokenizer, tok, symbol: str) -> list:
+    """The former split of a token into its subtokens at a particular symbol."""
+    Token = retokenizer.typesystem.get_type(retokenizer.tokenType)
+
+    tokens = []
+    tok_text = tok.get_covered_text()
+    tok_splits = tok_text.split(symbol)
+
+    # insert splitting symbol at every second position
+    i = 1
+    while i < len(tok_splits):
+        tok_splits.insert(i, symbol)
+        i += 2
+
+    if not tok_splits[-1]:
+        del tok_splits[-1]
+    if not tok_splits[0]:
+        del tok_splits[0]
+
+    split_pos = len(tok_splits[0])
+    tok.end = tok.begin + split_pos
+
+    for split in tok_splits[1:]:
+        start = tok.begin + split_pos
+        end = tok.begin + split_pos + len(split)
+        tokens.append(Token(begin=start, end=end))
+        split_pos += len(split)
+
+    return tokens
+
+
+def split_off_signs_sequentially(retokenizer: Retokenizer):
+    """The former pipeline: one pass over the tokens (and one `add_all`) per splitting sign."""
+    cas = retokenizer.cas
+    for sign in SPLITTING_SIGNS:
+        tokens = []
+        for tok in cas.select(retokenizer.tokenType):
+            tok_text = tok.get_covered_text()
+            if sign in tok_text and len(tok_text) > 1:
+                tokens += splitting_at_symbol(retokenizer, tok, sign)
+        cas.add_all(tokens)
+
+
+def retokenize(cas, typesystem, single_pass: bool) -> Cas:
+    """Splits off the signs of the tokens of a CAS."""
+    retokenizer = Retokenizer(None, None)
+    retokenizer.typesystem = typesystem
+    retokenizer.cas = cas
+    if single_pass:
+        retokenizer.split_off_signs()
+    else:
+        split_off_signs_sequentially(retokenizer)
+    return cas
+
+
+def random_document(typesystem):
+    """Returns a function creating a CAS of a few random tokens made of letters and splitting signs."""
+    alphabet = "ab" + "".join(SPLITTING_SIGNS) + "..--''"
+    words = [
+        "".join(random.choice(alphabet) for _ in range(random.randint(1, 7)))
+        for _ in range(random.randint(1, 6))
+    ]
+    Token = typesystem.get_type(Retokenizer(None, None).tokenType)
+
+    def create_cas():
+        cas = Cas(typesystem=typesystem)
+        cas.sofa_string = "\t".join(words)
+        spans = []
+        pos = 0
+        for word in words:
+            spans.append(Token(begin=pos, end=pos + len(word)))
+            pos += len(word) + 1
+        cas.add_all(spans)
+        return cas
+
+    return words, create_cas
+
+
+def xmi_document(xmi_file: str, typesystem):
+    """Returns a function loading the CAS of an xmi file."""
+
+    def create_cas():
+        with open(xmi_file, "rb") as f:
+            return load_cas_from_xmi(f, typesystem=typesystem)
+
+    return xmi_file, create_cas
+
+
+def main(args):
+    logging.disable(logging.CRITICAL)
+    random.seed(int(args["--seed"]))
+    typesystem = get_typesystem(args["--schema"])
+
+    documents = [xmi_document(xmi_file, typesystem) for xmi_file in args["<xmi_file>"]]
+    documents += [random_document(typesystem) for _ in range(int(args["--n-random"]))]
+
+    sequential_time = 0
+    single_time = 0
+    mismatches = []
+    for name, create_cas in documents:
+        expected_cas, actual_cas = create_cas(), create_cas()
+
+        start = time.perf_counter()
+        retokenize(expected_cas, typesystem, single_pass=False)
+        sequential_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        retokenize(actual_cas, typesystem, single_pass=True)
+        single_time += time.perf_counter() - start
+
+        if actual_cas.to_xmi() != expected_cas.to_xmi():
+            mismatches.append(name)
+            print(f"MISMATCH {name}")
+
+    n_docs = len(documents)
+    print(f"{n_docs - len(mismatches)}/{n_docs} documents identical")
+    print(
+        f"sequential: {sequential_time:.2f}s, single pass: {single_time:.2f}s "
+        + f"({sequential_time / single_time:.1f}x)"
+    )
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    sys.exit(main(arguments))
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Check the alignment of system responses to the gold standard (`align_tokens`) on responses
+derived from HIPE TSV files, in which tokens were dropped, split in two or inserted.
+
+Every aligned pair of tokens must have the same surface and the alignment must keep the order
+of the tokens. The recall is the share of the tokens kept in a response that are aligned to their
+own gold token. The alignment is also timed on a shuffled document (its worst case).
+
+Usage:
+    scripts/validate_token_alignment.py [--edit-rate=<p> --min-recall=<r> --worst-case-size=<n> --seed=<s>] <tsv_file>...
+
+Options:
+    --edit-rate=<p>         Share of the tokens that are dropped, split or preceded by an insertion [default: 0.03].
+    --min-recall=<r>        Minimum recall [default: 0.99].
+    --worst-case-size=<n>   Number of tokens of the shuffled document [default: 20000].
+    --seed=<s>              Random seed [default: 42].
+"""
+
+import sys
+sys.path.append('./lib')
+import random
+import time
+from docopt import docopt
+
+from impresso.aggregate_system_responses import align_tokens, parse_submission
+
+
+def read_documents(tsv_file: str) -> list:
+    """Returns the tokens of each document of a TSV file."""
+    with open(tsv_file, "rb") as f:
+        df = parse_submission(f.read(), [])
+    return [group.TOKEN.astype(str).tolist() for _, group in df.groupby("DOCUMENT_ID", sort=False)]
+
+
+def edit_tokens(tokens: list, edit_rate: float) -> tuple:
+    """
+    Drops, splits or inserts tokens at random.
+    Returns the edited tokens and the position of each unchanged token in them (or -1).
+    """
+    edited = []
+    expected = []
+    for token in tokens:
+        edit = random.choice(["drop", "split", "insert"]) if random.random() < edit_rate else None
+        if edit == "drop" or (edit == "split" and len(token) < 2):
+            expected.append(-1)
+        elif edit == "split":
+            middle = len(token) // 2
+            edited += [token[:middle], token[middle:]]
+            expected.append(-1)
+        else:
+            if edit == "insert":
+                edited.append(random.choice(tokens))
+            expected.append(len(edited))
+            edited.append(token)
+    return edited, expected
+
+
+def check_alignment(gold_tokens: list, sub_tokens: list, aligned) -> bool:
+    """Whether aligned tokens have the same surface and are in the same order."""
+    positions = [j for j in aligned.tolist() if j >= 0]
+    same_surface = all(
+        gold_tokens[i] == sub_tokens[j] for i, j in enumerate(aligned.tolist()) if j >= 0
+    )
+    return same_surface and all(j < k for j, k in zip(positions, positions[1:]))
+
+
+def main(args):
+    random.seed(int(args["--seed"]))
+    edit_rate = float(args["--edit-rate"])
+
+    documents = [tokens for tsv_file in args["<tsv_file>"] for tokens in read_documents(tsv_file)]
+
+    n_kept = 0
+    n_recalled = 0
+    invalid = 0
+    align_time = 0
+    for tokens in documents:
+        edited, expected = edit_tokens(tokens, edit_rate)
+
+        start = time.perf_counter()
+        aligned = align_tokens(tokens, edited)
+        align_time += time.perf_counter() - start
+
+        if not check_alignment(tokens, edited, aligned):
+            invalid += 1
+        n_kept += sum(1 for j in expected if j >= 0)
+        n_recalled += sum(1 for i, j in enumerate(expected) if j >= 0 and aligned[i] == j)
+
+    recall = n_recalled / n_kept if n_kept else 1.0
+    print(f"{len(documents) - invalid}/{len(documents)} documents aligned consistently")
+    print(f"recall: {n_recalled}/{n_kept} ({recall:.2%}), {align_time:.2f}s")
+
+    all_tokens = [token for tokens in documents for token in tokens]
+    worst_case = [random.choice(all_tokens) for _ in range(int(args["--worst-case-size"]))]
+    shuffled = random.sample(worst_case, len(worst_case))
+    start = time.perf_counter()
+    aligned = align_tokens(worst_case, shuffled)
+    worst_time = time.perf_counter() - start
+    if not check_alignment(worst_case, shuffled, aligned):
+        invalid += 1
+    print(f"shuffled document of {len(worst_case)} tokens: {worst_time:.2f}s")
+
+    return 1 if invalid or recall < float(args["--min-recall"]) else 0
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    sys.exit(main(arguments))